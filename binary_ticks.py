@@ -0,0 +1,106 @@
+import json
+import struct
+import numpy as np
+import pandas as pd
+
+import timestamps
+
+# File layout:
+#   header: magic, n_rows, symbol table offset, symbol table length (32 bytes)
+#   n_rows fixed-width records of record_dtype
+#   symbol table: utf-8 json list, symbol_id indexes into it
+_magic = b"TICKS\x00\x01\x00"
+_header = struct.Struct("<8sqqq")
+record_dtype = np.dtype([("timestamp", "<i8"), ("price", "<f8"), ("quantity", "<f8"),
+                         ("symbol_id", "<i4"), ("side", "i1")], align=True)
+side_codes = {"BUY": 1, "SELL": -1}
+# csv columns read, index_col=False and naming them keep a line with extra fields readable by position,
+# as csv.reader in the streaming paths sees it, instead of failing the whole file
+csv_columns = ("timestamp", "symbol", "side", "price", "quantity")
+
+
+def convert_csv(csv_file_name, binary_file_name, chunk_size=1_000_000):
+    # malformed rows (bad timestamp, price or quantity) are dropped, returns (n_rows, n_dropped)
+    symbol_ids = {}
+    n_rows = n_dropped = 0
+    with open(binary_file_name, "wb") as f:
+        f.write(_header.pack(_magic, 0, 0, 0))
+        for df in pd.read_csv(csv_file_name, dtype=str, keep_default_na=False, chunksize=chunk_size,
+                              usecols=lambda name: name in csv_columns, index_col=False):
+            t, valid = timestamps.parse_epoch_seconds_array(df["timestamp"].to_numpy())
+            p = pd.to_numeric(df["price"], errors="coerce").to_numpy(dtype=np.float64)
+            q = pd.to_numeric(df["quantity"], errors="coerce").to_numpy(dtype=np.float64)
+            valid &= np.isfinite(p) & np.isfinite(q)
+
+            records = np.zeros(int(valid.sum()), dtype=record_dtype)
+            records["timestamp"], records["price"], records["quantity"] = t[valid], p[valid], q[valid]
+            codes, symbols = pd.factorize(df["symbol"].to_numpy()[valid])
+            global_ids = np.array([symbol_ids.setdefault(s, len(symbol_ids)) for s in symbols], dtype=np.int32)
+            records["symbol_id"] = global_ids[codes] if len(codes) else 0
+            if "side" in df:
+                records["side"] = df["side"][valid].map(side_codes).fillna(0).to_numpy(dtype=np.int8)
+
+            records.tofile(f)
+            n_rows += len(records)
+            n_dropped += len(df) - len(records)
+
+        symbol_table = json.dumps(list(symbol_ids)).encode()
+        symbol_table_offset = f.tell()
+        f.write(symbol_table)
+        f.seek(0)
+        f.write(_header.pack(_magic, n_rows, symbol_table_offset, len(symbol_table)))
+    return n_rows, n_dropped
+
+
+class TickFile:
+    # memory-mapped reader, every column is a zero-copy view into the file
+    def __init__(self, file_name):
+        with open(file_name, "rb") as f:
+            magic, self.n_rows, symbol_table_offset, symbol_table_length = _header.unpack(f.read(_header.size))
+            if magic != _magic:
+                raise ValueError(f"{file_name} is not a binary tick file")
+            f.seek(symbol_table_offset)
+            self.symbols = json.loads(f.read(symbol_table_length))
+        if self.n_rows:
+            self.records = np.memmap(file_name, dtype=record_dtype, mode="r", offset=_header.size, shape=(self.n_rows,))
+        else:
+            self.records = np.zeros(0, dtype=record_dtype)
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def timestamps(self):
+        return self.records["timestamp"]
+
+    @property
+    def prices(self):
+        return self.records["price"]
+
+    @property
+    def quantities(self):
+        return self.records["quantity"]
+
+    @property
+    def symbol_ids(self):
+        return self.records["symbol_id"]
+
+    @property
+    def sides(self):
+        return self.records["side"]
+
+    def iter_batches(self, batch_size=65536):
+        for start in range(0, self.n_rows, batch_size):
+            yield self.records[start:start + batch_size]
+
+    def iter_ticks(self, batch_size=65536):
+        # (epoch seconds, symbol, price, quantity) in file order
+        for batch in self.iter_batches(batch_size):
+            symbols = [self.symbols[i] for i in batch["symbol_id"].tolist()]
+            yield from zip(batch["timestamp"].tolist(), symbols, batch["price"].tolist(), batch["quantity"].tolist())
+
+
+if __name__ == "__main__":
+    import sys
+    n_rows, n_dropped = convert_csv(sys.argv[1], sys.argv[2])
+    print(f"wrote {n_rows} rows to {sys.argv[2]}, dropped {n_dropped} malformed rows")
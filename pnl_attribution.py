@@ -1,6 +1,10 @@
 import pandas as pd, numpy as np
 import collections
+import concurrent.futures
 import datetime
+import json
+import os
+from multiprocessing import shared_memory
 
 class DailyReport:
     def __init__(self):
@@ -39,60 +43,441 @@ class Report:
         return "\n".join([f"{date_str}\n{pnl}" for date_str, pnl in self.daily_report.items()])
 
 
-def analyze(df_price_history, df_fx_rates, df_executions):
-    report = Report()
+class MarketData:
+    # closes as a dense day x symbol array and eur_usd per day, a day is its offset from the first one and a symbol
+    # its dict code, so a lookup is O(1); a missing value falls back to the latest one at most max_fallback_days
+    # earlier, enough for a weekend next to a holiday, anything older raises KeyError like .loc would
+    def __init__(self, df_price_history, df_fx_rates, max_fallback_days=5):
+        date_codes, dates = pd.factorize(df_price_history.index.get_level_values("date"))
+        symbol_codes, symbols = pd.factorize(df_price_history.index.get_level_values("symbol"))
+        fx_ordinals = np.array([date.toordinal() for date in df_fx_rates.index], dtype=np.int64)
+        ordinals = np.array([date.toordinal() for date in dates], dtype=np.int64)
+        all_ordinals = np.concatenate([ordinals, fx_ordinals])
+        self.first_ordinal = int(all_ordinals.min()) if len(all_ordinals) else 0
+        self.n_days = (int(all_ordinals.max()) - self.first_ordinal + 1 if len(all_ordinals) else 0) + max_fallback_days
+        self.symbol_ids = {symbol: i for i, symbol in enumerate(symbols)}
 
-    for (symbol, date, strategy), df_exs in df_executions.groupby(['symbol', 'date', "strategy"]):
-        #print(f"{symbol=}, {date=}, {strategy=}")
-        #print(df_exs[["timestamp", "strategy", "symbol", "side", "price", "quantity"]])
+        closes = np.full((self.n_days, len(symbols)), np.nan)
+        closes[ordinals[date_codes] - self.first_ordinal, symbol_codes] = df_price_history.close_price.to_numpy()
+        self.closes = pd.DataFrame(closes).ffill(limit=max_fallback_days).to_numpy()
+        eur_usd = np.full(self.n_days, np.nan)
+        eur_usd[fx_ordinals - self.first_ordinal] = df_fx_rates.eur_usd.to_numpy()
+        # where a rate was given for the day itself
+        self.has_eur_usd_on = ~np.isnan(eur_usd)
+        self.eur_usd_by_day = pd.Series(eur_usd).ffill(limit=max_fallback_days).to_numpy()
 
-        open_positions = collections.deque()
-        realized_pnl = 0
-        for _, e in df_exs.iterrows():
-            remaining_quantity = e.quantity
-            while open_positions and open_positions[0]["side_v"] != e.side_v:
-                open_p = open_positions.popleft()
-                traded_q = min(open_p["quantity"], remaining_quantity)
-                trading_pnl = open_p["side_v"] * (e.price - open_p["price"]) * traded_q
-                realized_pnl += trading_pnl
-                
-                open_p["quantity"] -= traded_q
-                if open_p["quantity"]:
-                    open_positions.appendleft(open_p)
-
-                remaining_quantity -= traded_q
-                if not remaining_quantity:
-                    break
-
-            if remaining_quantity:
-                open_positions.append({"timestamp": e.timestamp, "side_v": e.side_v, "price": e.price, "quantity": remaining_quantity})
-
-        eod_price = df_price_history.loc[(date, symbol)].close_price
+    def _day(self, date):
+        day = date.toordinal() - self.first_ordinal
+        if not 0 <= day < self.n_days:
+            raise KeyError(date)
+        return day
+
+    def close_price(self, date, symbol):
+        close_price = self.closes[self._day(date), self.symbol_ids[symbol]]
+        if close_price != close_price:
+            raise KeyError((date, symbol))
+        return close_price
+
+    def eur_usd(self, date):
+        eur_usd = self.eur_usd_by_day[self._day(date)]
+        if eur_usd != eur_usd:
+            raise KeyError(date)
+        return eur_usd
+
+    def has_eur_usd(self, date):
+        # a rate for the day itself, no fallback
+        day = date.toordinal() - self.first_ordinal
+        return 0 <= day < self.n_days and bool(self.has_eur_usd_on[day])
+
+
+def match_fifo_lots(group_ids, sides, prices, quantities, n_groups):
+    # FIFO lot matching for every group at once, rows are contiguous per group (group_ids 0..n_groups-1 ascending)
+    # and in execution order within it. The j-th unit bought in a group always closes against its j-th unit sold,
+    # so the matches are the overlaps of the cumulative buy and sell quantity intervals.
+    # Returns the realized pnl per group, summed in the order the lots were matched, and the open lots
+    # (group ids, sides, prices, quantities) in FIFO order; exact for integer quantities
+    keep = quantities != 0
+    group_ids, sides, prices, quantities = group_ids[keep], sides[keep], prices[keep], quantities[keep]
+    n = len(group_ids)
+    rows = np.arange(n)
+    group_starts = np.searchsorted(group_ids, np.arange(n_groups + 1))
+    is_buy = sides > 0
+
+    # cumulative quantity of the row's side in its group, up to and including the row
+    ends = np.empty(n, dtype=quantities.dtype)
+    totals = []
+    for mask in (is_buy, ~is_buy):
+        cum = np.concatenate(([0], np.cumsum(np.where(mask, quantities, 0))))
+        ends[mask] = (cum[1:] - cum[group_starts[group_ids]])[mask]
+        totals.append(np.diff(cum[group_starts]))
+    matched_totals = np.minimum(*totals)
+
+    # the piece of quantity between two consecutive boundaries of either side belongs to the next buy
+    # and the next sell boundary, and is matched as long as both sides reach it
+    order = np.lexsort((ends, group_ids))
+    sorted_ends, sorted_groups = ends[order], group_ids[order]
+    piece_starts = np.concatenate(([0], sorted_ends[:-1]))
+    piece_starts[group_starts[:-1][np.diff(group_starts) > 0]] = 0
+    pieces = sorted_ends - piece_starts
+    next_buy = np.minimum.accumulate(np.where(is_buy[order], rows, n)[::-1])[::-1]
+    next_sell = np.minimum.accumulate(np.where(is_buy[order], n, rows)[::-1])[::-1]
+    matched = (pieces > 0) & (sorted_ends <= matched_totals[sorted_groups])
+    buy_rows, sell_rows = order[next_buy[matched]], order[next_sell[matched]]
+
+    # the earlier execution was the open lot, in the order the closing executions consumed them
+    open_rows, close_rows = np.minimum(buy_rows, sell_rows), np.maximum(buy_rows, sell_rows)
+    matching_order = np.lexsort((open_rows, close_rows))
+    open_rows, close_rows, traded = open_rows[matching_order], close_rows[matching_order], pieces[matched][matching_order]
+    trading_pnl = sides[open_rows] * (prices[close_rows] - prices[open_rows]) * traded
+
+    # summed one by one, a vectorized sum would round differently
+    realized_pnl = [0] * n_groups
+    for g, pnl in zip(group_ids[close_rows].tolist(), trading_pnl.tolist()):
+        realized_pnl[g] += pnl
+
+    # only the side with more quantity has anything left, from its first row past the matched total on
+    is_open = ends > matched_totals[group_ids]
+    open_quantities = np.minimum(quantities, ends - matched_totals[group_ids])
+    return realized_pnl, group_ids[is_open], sides[is_open], prices[is_open], open_quantities[is_open]
+
+
+def _group_executions(df_executions):
+    # (symbol, date, strategy) keys, and group ids, sides, prices and quantities with each group's rows
+    # contiguous and in their original order
+    groups = df_executions.groupby(['symbol', 'date', "strategy"])
+    group_keys = groups.size().index
+    # -1 for rows with a missing key, groupby leaves them out too
+    group_ids = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    order = np.argsort(group_ids, kind="stable")
+    order = order[group_ids[order] >= 0]
+    return (group_keys, group_ids[order], df_executions.side_v.to_numpy()[order],
+            df_executions.price.to_numpy()[order], df_executions.quantity.to_numpy()[order])
+
+
+def _attribute_groups(group_ids, sides, prices, quantities, eod_prices):
+    # realized pnl, unrealized pnl and open position value per group in EUR, group_ids from 0 to len(eod_prices) - 1
+    realized, lot_group_ids, lot_sides, lot_prices, lot_quantities = match_fifo_lots(
+        group_ids, sides, prices, quantities, len(eod_prices))
+    lot_starts = np.searchsorted(lot_group_ids, np.arange(len(eod_prices) + 1)).tolist()
+    lot_sides, lot_prices, lot_quantities = lot_sides.tolist(), lot_prices.tolist(), lot_quantities.tolist()
+
+    unrealized, open_position_values = [], []
+    for g, eod_price in enumerate(eod_prices.tolist()):
         unrealized_pnl = 0
-        open_quantity = 0
         open_position_value = 0
-        while open_positions:
-            open_p = open_positions.pop()
-            open_quantity += open_p["quantity"]
-            open_position_value += open_p["side_v"] * open_p["price"] * open_p["quantity"]
-            unrealized_pnl += open_p["side_v"] * (eod_price - open_p["price"]) * open_p["quantity"]
+        # newest lot first
+        for i in reversed(range(lot_starts[g], lot_starts[g + 1])):
+            open_position_value += lot_sides[i] * lot_prices[i] * lot_quantities[i]
+            unrealized_pnl += lot_sides[i] * (eod_price - lot_prices[i]) * lot_quantities[i]
+        unrealized.append(unrealized_pnl)
+        open_position_values.append(open_position_value)
+    return realized, unrealized, open_position_values
+
+
+def _eod_prices(market_data, group_keys):
+    return np.array([market_data.close_price(date, symbol) for symbol, date, _ in group_keys], dtype=np.float64)
+
 
-        eur_to_usd = df_fx_rates.loc[date].eur_usd
+def _update_report(report, market_data, group_keys, realized, unrealized, open_position_values):
+    # in group order, so the per strategy sums come out the same however the groups were attributed
+    # date -> (date string, next date, next date string)
+    dates = {}
+    for (symbol, date, strategy), realized_pnl, unrealized_pnl, open_position_value in zip(
+            group_keys, realized, unrealized, open_position_values):
+        eur_to_usd = market_data.eur_usd(date)
         realized_pnl_usd, unrealized_pnl_usd = realized_pnl * eur_to_usd, unrealized_pnl * eur_to_usd
-        #print(f"{eod_price=}, {open_quantity=}, {realized_pnl=}, {unrealized_pnl=}, total_pnl: {realized_pnl + unrealized_pnl}")
-        report.update_pnl(date.strftime("%Y-%m-%d"), strategy, realized_pnl_usd, unrealized_pnl_usd)
+        if date not in dates:
+            next_date = date + datetime.timedelta(days=1)
+            dates[date] = date.strftime("%Y-%m-%d"), next_date, next_date.strftime("%Y-%m-%d")
+        date_str, next_date, next_date_str = dates[date]
+        report.update_pnl(date_str, strategy, realized_pnl_usd, unrealized_pnl_usd)
 
-        next_date = date + datetime.timedelta(days=1)
-        if next_date in df_fx_rates.index:
-            next_eur_to_usd = df_fx_rates.loc[next_date].eur_usd
+        if market_data.has_eur_usd(next_date):
+            next_eur_to_usd = market_data.eur_usd(next_date)
             fx_impact = open_position_value * (next_eur_to_usd - eur_to_usd)
-            report.update_fx_impact(next_date.strftime("%Y-%m-%d"), strategy, fx_impact)
-        else:
-            fx_impact = None
-
+            report.update_fx_impact(next_date_str, strategy, fx_impact)
     return report
 
 
+def analyze(df_price_history, df_fx_rates, df_executions):
+    market_data = MarketData(df_price_history, df_fx_rates)
+    group_keys, *columns = _group_executions(df_executions)
+    return _update_report(Report(), market_data, group_keys,
+                          *_attribute_groups(*columns, _eod_prices(market_data, group_keys)))
+
+
+def _share(array):
+    # a copy of array in shared memory, and what a worker needs to map it
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.dtype.str, array.shape)
+
+
+def _attribute_shared_groups(specs, first_group, last_group, first_row, last_row):
+    # worker side of analyze_parallel, groups [first_group, last_group) are rows [first_row, last_row)
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        group_ids, sides, prices, quantities, eod_prices = (
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf) for shm, (_, dtype, shape) in zip(blocks, specs))
+        return _attribute_groups(group_ids[first_row:last_row] - first_group, sides[first_row:last_row],
+                                 prices[first_row:last_row], quantities[first_row:last_row],
+                                 eod_prices[first_group:last_group])
+    finally:
+        # the views above are gone by now, a block cannot be closed while one is left
+        group_ids = sides = prices = quantities = eod_prices = None
+        for shm in blocks:
+            shm.close()
+
+
+def analyze_parallel(df_price_history, df_fx_rates, df_executions, n_workers=None, tasks_per_worker=4):
+    # the same report as analyze, the groups are attributed in a process pool: split into runs of whole groups
+    # with about the same number of executions, the columns are put into shared memory once and every task
+    # maps them, only the per group results come back
+    n_workers = n_workers or os.cpu_count()
+    market_data = MarketData(df_price_history, df_fx_rates)
+    group_keys, *columns = _group_executions(df_executions)
+    columns.append(_eod_prices(market_data, group_keys))
+    n_groups, n_rows = len(group_keys), len(columns[0])
+
+    group_starts = np.searchsorted(columns[0], np.arange(n_groups + 1))
+    task_groups = np.unique(np.searchsorted(group_starts, np.linspace(0, n_rows, n_workers * tasks_per_worker + 1)))
+    task_groups = np.unique(np.concatenate(([0], np.minimum(task_groups, n_groups), [n_groups]))).tolist()
+
+    blocks, specs = zip(*(_share(column) for column in columns))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as pool:
+            futures = [pool.submit(_attribute_shared_groups, specs, first_group, last_group,
+                                   int(group_starts[first_group]), int(group_starts[last_group]))
+                       for first_group, last_group in zip(task_groups[:-1], task_groups[1:])]
+            results = [future.result() for future in futures]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    realized, unrealized, open_position_values = ([value for result in results for value in result[i]] for i in range(3))
+    return _update_report(Report(), market_data, group_keys, realized, unrealized, open_position_values)
+
+
+# bumped whenever the arrays PositionBook.snapshot writes change
+_snapshot_version = 1
+
+
+class PositionBook:
+    # open FIFO lots per (symbol, strategy) carried from day to day, with the mark-to-market they had at the last close,
+    # so a day only needs its own executions. A day's unrealized pnl is the change of the mark-to-market over the day
+    # (closed lots give back what they were marked at), so daily totals add up; on a new book's first day it is
+    # the same as analyze
+    def __init__(self):
+        # (symbol, strategy) -> (sides, prices, quantities) in FIFO order, and -> mark-to-market in EUR
+        self.lots = {}
+        self.marks = {}
+        self.last_date = None
+
+    def process_day(self, date, df_executions, market_data, report=None):
+        # date's executions in time order, prepared like in __main__, adds the day to report and returns it
+        if self.last_date is not None and date <= self.last_date:
+            raise ValueError(f"{date} is not after the book's last day {self.last_date}")
+        report = report if report is not None else Report()
+
+        groups = df_executions.groupby(['symbol', "strategy"])
+        execution_keys = list(groups.size().index)
+        keys = sorted(set(execution_keys) | set(self.lots))
+        key_ids = {key: g for g, key in enumerate(keys)}
+        execution_ids = np.array([key_ids[key] for key in execution_keys], dtype=np.int64)
+        ngroups = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        valid = ngroups >= 0
+
+        # carried lots go in front of the day's executions, as if they were still in the queue
+        carried_keys = [key for key in keys if key in self.lots]
+        group_ids = np.concatenate([np.repeat([key_ids[key] for key in carried_keys],
+                                              [len(self.lots[key][0]) for key in carried_keys]).astype(np.int64),
+                                    execution_ids[ngroups[valid]]])
+        columns = [np.concatenate([self.lots[key][i] for key in carried_keys] + [column])
+                   for i, column in enumerate((df_executions.side_v.to_numpy()[valid],
+                                               df_executions.price.to_numpy()[valid],
+                                               df_executions.quantity.to_numpy()[valid]))]
+        order = np.argsort(group_ids, kind="stable")
+        realized, lot_group_ids, lot_sides, lot_prices, lot_quantities = match_fifo_lots(
+            group_ids[order], *(column[order] for column in columns), len(keys))
+        lot_starts = np.searchsorted(lot_group_ids, np.arange(len(keys) + 1)).tolist()
+
+        eur_to_usd = market_data.eur_usd(date)
+        next_date = date + datetime.timedelta(days=1)
+        next_eur_to_usd = market_data.eur_usd(next_date) if market_data.has_eur_usd(next_date) else None
+        date_str, next_date_str = date.strftime("%Y-%m-%d"), next_date.strftime("%Y-%m-%d")
+        # the book and report only change once every close was found
+        new_lots, new_marks, pnl_updates, fx_impact_updates = {}, {}, [], []
+        for g, (symbol, strategy) in enumerate(keys):
+            lots = slice(lot_starts[g], lot_starts[g + 1])
+            sides, prices, quantities = lot_sides[lots].tolist(), lot_prices[lots].tolist(), lot_quantities[lots].tolist()
+
+            eod_price = market_data.close_price(date, symbol)
+            mark = 0
+            open_position_value = 0
+            # newest lot first
+            for i in reversed(range(len(sides))):
+                open_position_value += sides[i] * prices[i] * quantities[i]
+                mark += sides[i] * (eod_price - prices[i]) * quantities[i]
+            unrealized_pnl = mark - self.marks.get((symbol, strategy), 0)
+            if sides:
+                new_lots[(symbol, strategy)] = (lot_sides[lots], lot_prices[lots], lot_quantities[lots])
+                new_marks[(symbol, strategy)] = mark
+
+            pnl_updates.append((strategy, realized[g] * eur_to_usd, unrealized_pnl * eur_to_usd))
+            if next_eur_to_usd is not None:
+                fx_impact_updates.append((strategy, open_position_value * (next_eur_to_usd - eur_to_usd)))
+
+        for strategy, realized_pnl, unrealized_pnl in pnl_updates:
+            report.update_pnl(date_str, strategy, realized_pnl, unrealized_pnl)
+        for strategy, fx_impact in fx_impact_updates:
+            report.update_fx_impact(next_date_str, strategy, fx_impact)
+        self.lots, self.marks, self.last_date = new_lots, new_marks, date
+        return report
+
+    def analyze(self, df_price_history, df_fx_rates, df_executions, report=None):
+        # every day of df_executions in date order, and every day of df_price_history in between (from the day after
+        # the book's last one if it has one), so carried lots are marked on days without executions too
+        report = report if report is not None else Report()
+        if df_executions.empty:
+            return report
+        market_data = MarketData(df_price_history, df_fx_rates)
+        df_days = dict(iter(df_executions.groupby("date")))
+        first_date = min(df_days) if self.last_date is None else self.last_date + datetime.timedelta(days=1)
+        last_date = max(df_days)
+        price_dates = df_price_history.index.get_level_values("date").unique()
+        dates = set(df_days) | {date for date in price_dates if first_date <= date <= last_date}
+        for date in sorted(dates):
+            self.process_day(date, df_days.get(date, df_executions.iloc[:0]), market_data, report)
+        return report
+
+    def snapshot(self, file_name):
+        # lots and marks as numpy arrays in one npz file, written aside and renamed into place
+        keys = list(self.lots)
+        lots = [self.lots[key] for key in keys]
+        meta = {"version": _snapshot_version, "keys": keys,
+                "last_date": None if self.last_date is None else self.last_date.isoformat()}
+        arrays = {"meta": np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+                  "marks": np.array([self.marks[key] for key in keys], dtype=np.float64),
+                  "n_lots": np.array([len(sides) for sides, _, _ in lots], dtype=np.int64)}
+        for i, name in enumerate(("sides", "prices", "quantities")):
+            arrays[name] = np.concatenate([lot[i] for lot in lots]) if lots else np.zeros(0)
+        with open(file_name + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(file_name + ".tmp", file_name)
+
+    @classmethod
+    def restore(cls, file_name):
+        with np.load(file_name, allow_pickle=False) as snapshot:
+            arrays = dict(snapshot)
+        meta = json.loads(arrays["meta"].tobytes())
+        if meta["version"] != _snapshot_version:
+            raise ValueError(f"{file_name} is a version {meta['version']} snapshot, expected {_snapshot_version}")
+        book = cls()
+        book.last_date = None if meta["last_date"] is None else datetime.date.fromisoformat(meta["last_date"])
+        starts = np.concatenate(([0], np.cumsum(arrays["n_lots"])))
+        for g, key in enumerate(map(tuple, meta["keys"])):
+            lots = slice(starts[g], starts[g + 1])
+            book.lots[key] = (arrays["sides"][lots], arrays["prices"][lots], arrays["quantities"][lots])
+            book.marks[key] = float(arrays["marks"][g])
+        return book
+
+
+class _Position:
+    # one (symbol, strategy) of a PnLBook, its lots are [side, price, quantity] and all on one side
+    __slots__ = ("lots", "quantity", "cost", "realized_pnl", "previous_mark", "previous_value")
+
+    def __init__(self):
+        self.lots = collections.deque()
+        # sum of the lots' quantity and price * quantity, so marking is O(1)
+        self.quantity = 0
+        self.cost = 0.0
+        self.realized_pnl = 0
+        # mark-to-market and open position value at the previous close, in EUR
+        self.previous_mark = 0
+        self.previous_value = 0
+
+
+class PnLBook:
+    # one day's pnl as executions stream in: a fill updates realized pnl and the FIFO lots in O(matched lots),
+    # report() gives the live figures in USD as PositionBook.process_day defines them, against the latest mark of
+    # each symbol (its last update_mark or fill, whichever came last), starting from the previous close's
+    # position_book if given
+    def __init__(self, eur_usd, position_book=None, previous_eur_usd=None):
+        self.eur_usd = eur_usd
+        self.previous_eur_usd = previous_eur_usd
+        self.positions = {}
+        self.marks = {}
+        if position_book is not None:
+            for key, (sides, prices, quantities) in position_book.lots.items():
+                position = self.positions[key] = _Position()
+                position.lots.extend([s, p, q] for s, p, q in zip(sides.tolist(), prices.tolist(), quantities.tolist()))
+                for s, p, q in reversed(position.lots):
+                    position.quantity += q
+                    position.cost += p * q
+                    position.previous_value += s * p * q
+                position.previous_mark = position_book.marks[key]
+
+    def add_execution(self, strategy, symbol, side, price, quantity):
+        # side "BUY", "SELL" or +1 / -1, returns the fill's realized pnl in EUR
+        if type(side) == str:
+            side = -1 if side == "SELL" else +1
+        position = self.positions.get((symbol, strategy))
+        if position is None:
+            position = self.positions[(symbol, strategy)] = _Position()
+        self.marks[symbol] = price
+
+        lots = position.lots
+        remaining_quantity = quantity
+        realized_pnl = 0
+        while lots and lots[0][0] != side and remaining_quantity:
+            lot = lots[0]
+            traded_q = min(lot[2], remaining_quantity)
+            trading_pnl = lot[0] * (price - lot[1]) * traded_q
+            position.realized_pnl += trading_pnl
+            realized_pnl += trading_pnl
+
+            lot[2] -= traded_q
+            position.quantity -= traded_q
+            position.cost -= lot[1] * traded_q
+            if not lot[2]:
+                lots.popleft()
+            remaining_quantity -= traded_q
+
+        if remaining_quantity:
+            lots.append([side, price, remaining_quantity])
+            position.quantity += remaining_quantity
+            position.cost += price * remaining_quantity
+        elif not lots:
+            # flat, drop the rounding the running cost picked up
+            position.cost = 0.0
+        return realized_pnl
+
+    def update_mark(self, symbol, price):
+        self.marks[symbol] = price
+
+    def update_fx_rate(self, eur_usd):
+        self.eur_usd = eur_usd
+
+    def report(self):
+        # DailyReport of the day so far, positions in the order process_day reports them
+        daily_report = DailyReport()
+        for (symbol, strategy), position in sorted(self.positions.items()):
+            mark = self.marks.get(symbol)
+            if not position.lots:
+                mark_to_market = 0
+            elif mark is None:
+                # carried lots of a symbol not traded or marked yet today
+                mark_to_market = position.previous_mark
+            else:
+                mark_to_market = position.lots[0][0] * (mark * position.quantity - position.cost)
+            daily_report.update_pnl(strategy, position.realized_pnl * self.eur_usd,
+                                    (mark_to_market - position.previous_mark) * self.eur_usd)
+            if self.previous_eur_usd is not None:
+                daily_report.update_fx_impact(strategy, position.previous_value * (self.eur_usd - self.previous_eur_usd))
+        return daily_report
+
+
 if __name__ == "__main__":
     df_price_history = pd.read_csv("pnl_attribution_mock_multi_day/price_history.csv")
     df_price_history["date"] = pd.to_datetime(df_price_history["date"]).dt.date
@@ -0,0 +1,199 @@
+import collections
+import datetime
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import pnl_attribution
+
+
+# iterrows and deque of dicts lot matching, kept as the baseline to compare against
+def _analyze_iterrows(df_price_history, df_fx_rates, df_executions):
+    report = pnl_attribution.Report()
+
+    for (symbol, date, strategy), df_exs in df_executions.groupby(['symbol', 'date', "strategy"]):
+        open_positions = collections.deque()
+        realized_pnl = 0
+        for _, e in df_exs.iterrows():
+            remaining_quantity = e.quantity
+            while open_positions and open_positions[0]["side_v"] != e.side_v:
+                open_p = open_positions.popleft()
+                traded_q = min(open_p["quantity"], remaining_quantity)
+                trading_pnl = open_p["side_v"] * (e.price - open_p["price"]) * traded_q
+                realized_pnl += trading_pnl
+
+                open_p["quantity"] -= traded_q
+                if open_p["quantity"]:
+                    open_positions.appendleft(open_p)
+
+                remaining_quantity -= traded_q
+                if not remaining_quantity:
+                    break
+
+            if remaining_quantity:
+                open_positions.append({"timestamp": e.timestamp, "side_v": e.side_v, "price": e.price, "quantity": remaining_quantity})
+
+        eod_price = df_price_history.loc[(date, symbol)].close_price
+        unrealized_pnl = 0
+        open_position_value = 0
+        while open_positions:
+            open_p = open_positions.pop()
+            open_position_value += open_p["side_v"] * open_p["price"] * open_p["quantity"]
+            unrealized_pnl += open_p["side_v"] * (eod_price - open_p["price"]) * open_p["quantity"]
+
+        eur_to_usd = df_fx_rates.loc[date].eur_usd
+        report.update_pnl(date.strftime("%Y-%m-%d"), strategy, realized_pnl * eur_to_usd, unrealized_pnl * eur_to_usd)
+
+        next_date = date + datetime.timedelta(days=1)
+        if next_date in df_fx_rates.index:
+            fx_impact = open_position_value * (df_fx_rates.loc[next_date].eur_usd - eur_to_usd)
+            report.update_fx_impact(next_date.strftime("%Y-%m-%d"), strategy, fx_impact)
+
+    return report
+
+
+def generate_inputs(n_executions, n_symbols=50, n_strategies=4, n_days=5, seed=0):
+    # (df_price_history, df_fx_rates, df_executions) prepared like pnl_attribution's __main__
+    rng = np.random.default_rng(seed)
+    dates = [datetime.date(2024, 7, 1) + datetime.timedelta(days=i) for i in range(n_days)]
+    symbols = [f"S{i:03d}" for i in range(n_symbols)]
+    df_price_history = pd.DataFrame({"date": np.repeat(dates, n_symbols), "symbol": symbols * n_days,
+                                     "close_price": rng.uniform(50, 250, n_days * n_symbols).round(2)})
+    df_price_history = df_price_history.set_index(["date", "symbol"])
+    df_fx_rates = pd.DataFrame({"date": dates, "eur_usd": rng.uniform(0.9, 1.2, n_days).round(4)}).set_index("date")
+
+    df_executions = pd.DataFrame({
+        "timestamp": pd.Timestamp(dates[0]) + pd.to_timedelta(rng.integers(0, n_days * 86400, n_executions), unit="s"),
+        "strategy": np.array([f"alpha{i}" for i in range(n_strategies)])[rng.integers(0, n_strategies, n_executions)],
+        "symbol": np.array(symbols)[rng.integers(0, n_symbols, n_executions)],
+        "side": np.where(rng.random(n_executions) < 0.5, "BUY", "SELL"),
+        "price": rng.uniform(50, 250, n_executions).round(2),
+        "quantity": rng.integers(1, 300, n_executions),
+    }).sort_values(["timestamp"])
+    df_executions["date"] = df_executions.timestamp.dt.date
+    df_executions["side_v"] = np.where(df_executions.side == "SELL", -1, +1)
+    return df_price_history, df_fx_rates, df_executions
+
+
+def assert_reports_equal(report, expected_report):
+    assert list(report.daily_report) == list(expected_report.daily_report)
+    for date_str, daily_report in report.daily_report.items():
+        expected = expected_report.daily_report[date_str]
+        for name in ("realized_pnl_per_strategy", "unrealized_pnl_per_strategy", "total_pnl_per_strategy",
+                     "fx_impact_per_strategy"):
+            assert getattr(daily_report, name) == getattr(expected, name), f"{date_str} {name}"
+
+
+def benchmark_lot_matching(n_executions=200_000):
+    print(f"=== analyze, {n_executions} executions ===")
+    inputs = generate_inputs(n_executions)
+    t1 = time.perf_counter()
+    expected_report = _analyze_iterrows(*inputs)
+    t2 = time.perf_counter()
+    report = pnl_attribution.analyze(*inputs)
+    t3 = time.perf_counter()
+    assert_reports_equal(report, expected_report)
+    print(f"iterrows and deque: {t2 - t1:.3f}s, match_fifo_lots: {t3 - t2:.3f}s, {(t2 - t1) / (t3 - t2):.0f}x, "
+          f"reports identical")
+
+
+def benchmark_market_data(n_executions=200_000, n_symbols=500, n_strategies=10, n_days=10):
+    df_price_history, df_fx_rates, df_executions = generate_inputs(n_executions, n_symbols=n_symbols,
+                                                                   n_strategies=n_strategies, n_days=n_days)
+    group_keys = list(df_executions.groupby(['symbol', 'date', "strategy"]).size().index)
+    print(f"=== close and fx lookups per group, {len(group_keys)} groups ===")
+
+    t1 = time.perf_counter()
+    for symbol, date, _ in group_keys:
+        df_price_history.loc[(date, symbol)].close_price
+        df_fx_rates.loc[date].eur_usd
+        next_date = date + datetime.timedelta(days=1)
+        if next_date in df_fx_rates.index:
+            df_fx_rates.loc[next_date].eur_usd
+    t2 = time.perf_counter()
+    market_data = pnl_attribution.MarketData(df_price_history, df_fx_rates)
+    t3 = time.perf_counter()
+    for symbol, date, _ in group_keys:
+        market_data.close_price(date, symbol)
+        market_data.eur_usd(date)
+        next_date = date + datetime.timedelta(days=1)
+        if market_data.has_eur_usd(next_date):
+            market_data.eur_usd(next_date)
+    t4 = time.perf_counter()
+    print(f".loc: {(t2 - t1) / len(group_keys) * 1e6:.1f}us per group, MarketData: {(t4 - t3) / len(group_keys) * 1e6:.1f}us "
+          f"per group after {(t3 - t2) * 1e3:.1f}ms to build it")
+
+    t1 = time.perf_counter()
+    pnl_attribution.analyze(df_price_history, df_fx_rates, df_executions)
+    print(f"analyze: {time.perf_counter() - t1:.3f}s")
+
+
+def benchmark_position_book(n_executions_per_day=20_000, n_days=20):
+    print(f"=== PositionBook, day {n_days} of {n_days} with {n_executions_per_day} executions a day ===")
+    df_price_history, df_fx_rates, df_executions = generate_inputs(n_executions_per_day * n_days, n_days=n_days)
+    last_date = df_executions.date.max()
+    df_history, df_last_day = df_executions[df_executions.date < last_date], df_executions[df_executions.date == last_date]
+
+    t1 = time.perf_counter()
+    expected_report = pnl_attribution.PositionBook().analyze(df_price_history, df_fx_rates, df_executions)
+    t2 = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "book.snapshot")
+        report = pnl_attribution.Report()
+        book = pnl_attribution.PositionBook()
+        book.analyze(df_price_history, df_fx_rates, df_history, report)
+        book.snapshot(file_name)
+        t3 = time.perf_counter()
+        book = pnl_attribution.PositionBook.restore(file_name)
+        book.process_day(last_date, df_last_day, pnl_attribution.MarketData(df_price_history, df_fx_rates), report)
+        t4 = time.perf_counter()
+        n_lots = sum(len(sides) for sides, _, _ in book.lots.values())
+    assert_reports_equal(report, expected_report)
+    print(f"every day again: {t2 - t1:.3f}s, restore and the new day: {t4 - t3:.3f}s, "
+          f"{len(book.lots)} positions with {n_lots} open lots carried, reports identical")
+
+
+def benchmark_pnl_book(n_executions=200_000, n_reports=1_000):
+    print(f"=== PnLBook, {n_executions} executions streamed in ===")
+    df_price_history, df_fx_rates, df_executions = generate_inputs(n_executions, n_days=1)
+    executions = list(df_executions[["strategy", "symbol", "side_v", "price", "quantity"]].itertuples(index=False))
+    book = pnl_attribution.PnLBook(df_fx_rates.eur_usd.iloc[0])
+    latencies = []
+    for strategy, symbol, side, price, quantity in executions:
+        t1 = time.perf_counter()
+        book.add_execution(strategy, symbol, side, price, quantity)
+        latencies.append(time.perf_counter() - t1)
+    latencies.sort()
+    t1 = time.perf_counter()
+    for _ in range(n_reports):
+        book.report()
+    report_seconds = (time.perf_counter() - t1) / n_reports
+    print(f"add_execution: p50 {latencies[len(latencies) // 2] * 1e6:.1f}us, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f}us, "
+          f"report over {len(book.positions)} positions: {report_seconds * 1e3:.2f}ms")
+
+
+def benchmark_parallel_attribution(n_executions=1_000_000, n_symbols=500, n_strategies=10, n_days=10):
+    inputs = generate_inputs(n_executions, n_symbols=n_symbols, n_strategies=n_strategies, n_days=n_days)
+    print(f"=== analyze_parallel, {n_executions} executions, {os.cpu_count()} cpus ===")
+    t1 = time.perf_counter()
+    expected_report = pnl_attribution.analyze(*inputs)
+    serial_seconds = time.perf_counter() - t1
+    timings = []
+    for n_workers in sorted({1, 2, 4, os.cpu_count()}):
+        t1 = time.perf_counter()
+        report = pnl_attribution.analyze_parallel(*inputs, n_workers=n_workers)
+        timings.append(f"{n_workers} workers: {time.perf_counter() - t1:.3f}s")
+        assert_reports_equal(report, expected_report)
+    print(f"analyze: {serial_seconds:.3f}s, " + ", ".join(timings) + ", reports identical")
+
+
+if __name__ == "__main__":
+    benchmark_lot_matching()
+    benchmark_market_data()
+    benchmark_position_book()
+    benchmark_pnl_book()
+    benchmark_parallel_attribution()
@@ -1,98 +1,780 @@
+import asyncio
 import csv
-import datetime
 import collections
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import types
+import urllib.parse
+import zlib
+import numpy as np
+import pandas as pd
 
-_datetime_format = "%Y-%m-%dT%H:%M:%SZ"
+import binary_ticks
+import timestamps
+
+# ticks older than the latest seen tick by more than this are dropped
+_max_lateness_seconds = 90
+_max_lateness_minutes = -(-_max_lateness_seconds // 60)
+_chunk_size = 1024
+# a gap of more than this many empty bars is not laid out, see BarSeries
+_max_empty_rows = 60
+# how often a ShardedAggregator waiting on a shard checks that the worker is still alive
+_shard_poll_seconds = 1.0
+
+logger = logging.getLogger(__name__)
 
 def _parse_tpq(t, p, q):
     if type(t) == str:
-        t = datetime.datetime.strptime(t, _datetime_format)
+        t = timestamps.parse_epoch_seconds(t)
     if type(p) == str:
         p = float(p)
     if type(q) == str:
         q = float(q)
     return t, p, q
 
+def _rejection_reason(row, i_timestamp, i_price, i_quantity):
+    # slow path, only for rows that failed to parse. missing fields count as empty, as pandas reads them
+    row = row + [""] * (max(i_timestamp, i_price, i_quantity) + 1 - len(row))
+    try:
+        timestamps.parse_epoch_seconds(row[i_timestamp])
+    except ValueError:
+        return "bad_timestamp"
+    try:
+        if math.isfinite(float(row[i_price])):
+            return "bad_quantity"
+    except ValueError:
+        pass
+    return "bad_price"
+
+# read-only view of one row of a BarSeries, i counts rows from the start of the series
+# including those already spilled to disk
 class Bar:
-    def __init__(self, t, o, h, l, c, q):
-        self.t = t.replace(second=0)
-        self.o = o
-        self.h = h
-        self.l = l
-        self.c = c
-        self.q = q
+    __slots__ = ("_series", "_i")
+
+    def __init__(self, series, i):
+        self._series = series
+        self._i = i
+
+    def _row(self):
+        row = self._i - self._series.row_offset
+        if row < 0:
+            raise IndexError("bar was spilled to disk, query it with get_bars")
+        return row
+
+    @property
+    def minute(self):
+        return int(self._series.minutes[self._row()])
+
+    @property
+    def t(self):
+        return timestamps.from_epoch_seconds(self.minute * 60)
+
+    @property
+    def o(self):
+        return float(self._series.opens[self._row()])
+
+    @property
+    def h(self):
+        return float(self._series.highs[self._row()])
+
+    @property
+    def l(self):
+        return float(self._series.lows[self._row()])
+
+    @property
+    def c(self):
+        return float(self._series.closes[self._row()])
+
+    @property
+    def q(self):
+        return float(self._series.volumes[self._row()])
 
     def __str__(self):
         return f"{self.t}, ({self.o}, {self.h}, {self.l}, {self.c}), {self.q}"
 
-    def update(self, t, p, q):
-        t_minutely = t.replace(second=0)
-        if self.t != t_minutely:
-            return
+    def __reduce__(self):
+        # pickles as a detached copy of the row, e.g. when sent back from a shard process
+        return _detached_bar, (self.minute, self.o, self.h, self.l, self.c, self.q)
 
-        self.h = max(self.h, p)
-        self.l = min(self.l, p)
-        self.q += q
+def _detached_bar(minute, o, h, l, c, q):
+    row = types.SimpleNamespace(row_offset=0, minutes=[minute], opens=[o], highs=[h], lows=[l], closes=[c], volumes=[q])
+    return Bar(row, 0)
 
 class BarSeries:
-    def __init__(self):
-        self.t_latest = datetime.datetime.fromtimestamp(0)
-        self.bars = []
+    # minute epoch, open, high, low, close, volume, and the epoch second of the tick behind the close
+    _columns = (("minutes", np.int64), ("opens", np.float64), ("highs", np.float64),
+                ("lows", np.float64), ("closes", np.float64), ("volumes", np.float64), ("last_seconds", np.int64))
+    minutes_per_bar = 1
+
+    # rows are laid out densely by time: row i holds the bar starting at base_minute + i * minutes_per_bar,
+    # and bars without any tick are left empty with a NaN open. a tick more than _max_empty_rows bars past
+    # the newest row starts a new run right after it instead, with base_minute moved back to match, so a
+    # far-off timestamp does not allocate every bar in between. rows keep their own start in minutes.
+    # rollups maps minutes_per_bar to a RollupBarSeries kept up to date by the same ticks.
+    # with retention_minutes set, completed rows older than that are appended to spill_file_name
+    # (or discarded without one) and dropped from memory, get_bars reads both.
+    def __init__(self, chunk_size=_chunk_size, rollups=(), retention_minutes=None, spill_file_name=None):
+        self.chunk_size = chunk_size
+        self.t_latest = None
+        self.base_minute = None
+        self.n = 0
+        self.n_bars = 0
+        # rows before n_completed are final, no tick within the lateness limit can reach them
+        self.n_completed = 0
+        self.n_late_dropped = 0
+        # counted from the start of the series like Bar._i
+        self.i_latest_completed = None
+        for name, dtype in self._columns:
+            setattr(self, name, np.empty(chunk_size, dtype=dtype))
+
+        self.retention_rows = None if retention_minutes is None else -(-retention_minutes // self.minutes_per_bar)
+        self.spill_file_name = spill_file_name
+        self.row_offset = 0
+        self.n_spilled_bars = 0
+
+        def rollup_spill_file_name(minutes_per_bar):
+            return None if spill_file_name is None else f"{spill_file_name}.{minutes_per_bar}m"
+        self.rollups = {minutes_per_bar: RollupBarSeries(minutes_per_bar, chunk_size=chunk_size,
+                                                         retention_minutes=retention_minutes,
+                                                         spill_file_name=rollup_spill_file_name(minutes_per_bar))
+                        for minutes_per_bar in rollups}
 
     def __str__(self):
-        return '\n'.join([str(b) for b in self.bars])
+        return '\n'.join([str(b) for b in self])
+
+    def __len__(self):
+        return self.n_bars
+
+    def __iter__(self):
+        # bars still in memory
+        return (Bar(self, self.row_offset + i) for i in range(self.n) if not self._is_empty_row(i))
 
     def is_empty(self):
-        return not self.bars
+        return self.n_bars == 0
+
+    def _is_empty_row(self, i):
+        return math.isnan(self.opens[i])
+
+    def _grow(self, min_capacity):
+        capacity = len(self.minutes)
+        while capacity < min_capacity:
+            capacity += self.chunk_size
+        for name, dtype in self._columns:
+            column = np.empty(capacity, dtype=dtype)
+            column[:self.n] = getattr(self, name)[:self.n]
+            setattr(self, name, column)
+
+    def _extend_to(self, i):
+        if i >= len(self.minutes):
+            self._grow(i + 1)
+        self.minutes[self.n:i+1] = self.base_minute + np.arange(self.n, i + 1) * self.minutes_per_bar
+        for column in (self.opens, self.highs, self.lows, self.closes):
+            column[self.n:i+1] = np.nan
+        self.volumes[self.n:i+1] = 0
+        self.last_seconds[self.n:i+1] = self.minutes[self.n:i+1] * 60
+        self.n = i + 1
+
+    def _fill_bar(self, i, t, p, q):
+        self.opens[i] = self.highs[i] = self.lows[i] = self.closes[i] = p
+        self.volumes[i] = q
+        self.last_seconds[i] = t
+        self.n_bars += 1
+
+    def _update_bar(self, i, t, p, q):
+        if p > self.highs[i]:
+            self.highs[i] = p
+        elif p < self.lows[i]:
+            self.lows[i] = p
+        # the close is the latest trade in the bar, a reordered earlier tick does not move it
+        if t >= self.last_seconds[i]:
+            self.closes[i] = p
+            self.last_seconds[i] = t
+        self.volumes[i] += q
+
+    def _set_base_minute(self, first_minute, first_row=0):
+        # the run of rows from first_row on starts at first_minute,
+        # leave room for ticks up to the lateness limit before the first one
+        minute = first_minute - _max_lateness_minutes
+        self.base_minute = minute - minute % self.minutes_per_bar - first_row * self.minutes_per_bar
+        self._update_next_completion()
+
+    def _is_gap(self, prev_minute, minute):
+        # more than _max_empty_rows empty bars between the bars of the two minutes
+        return minute // self.minutes_per_bar - prev_minute // self.minutes_per_bar - 1 > _max_empty_rows
+
+    def _update_next_completion(self):
+        # t_latest at which the row after the completed ones becomes final, saves the check on most ticks
+        self._t_next_completion = self.base_minute * 60 + (self.n_completed + 1) * 60 * self.minutes_per_bar + \
+            _max_lateness_seconds
 
-    def _append_bar(self, t, p, q):
-        self.bars.append(Bar(t.replace(second=0), p, p, p, p, q))
-        self.t_latest = max(self.t_latest, t)
+    def _completed_row_count(self):
+        # a bar is final once a tick in it would be dropped: its end <= t_latest - lateness
+        seconds_per_bar = 60 * self.minutes_per_bar
+        return min(self.n, (self.t_latest - _max_lateness_seconds - self.base_minute * 60) // seconds_per_bar)
 
+    def _complete_bars(self, n_completed):
+        if n_completed <= self.n_completed:
+            return ()
+        # only rows completed before this call are spilled, the bars returned below stay readable
+        n_completed -= self._spill_over_retention()
+        completed = [Bar(self, self.row_offset + i) for i in range(self.n_completed, n_completed)
+                     if not self._is_empty_row(i)]
+        if completed:
+            self.i_latest_completed = completed[-1]._i
+        self.n_completed = n_completed
+        self._update_next_completion()
+        return completed
+
+    def _spill_over_retention(self):
+        if self.retention_rows is not None and self.n - self.retention_rows >= self.chunk_size:
+            return self._spill()
+        return 0
+
+    def _spill_loaded(self):
+        # _load completes its bars in one call, so nothing was spilled yet: call once they are published
+        for rollup in self.rollups.values():
+            rollup._spill_loaded()
+        if self._spill_over_retention():
+            # and give back the capacity the whole load needed
+            capacity = max(1, -(-self.n // self.chunk_size)) * self.chunk_size
+            for name, _ in self._columns:
+                setattr(self, name, getattr(self, name)[:capacity].copy())
+
+    def _spill(self):
+        k = min(self.n - self.retention_rows, self.n_completed)
+        if self.i_latest_completed is not None:
+            # keep the latest completed bar around for get_latest_completed_bar
+            k = min(k, self.i_latest_completed - self.row_offset)
+        if k <= 0:
+            return 0
+
+        rows = np.flatnonzero(~np.isnan(self.opens[:k]))
+        if self.spill_file_name is not None and len(rows):
+            records = np.empty(len(rows), dtype=self._spill_dtype())
+            for name, _ in self._columns:
+                records[name] = getattr(self, name)[rows]
+            with open(self.spill_file_name, "ab" if self.n_spilled_bars else "wb") as f:
+                records.tofile(f)
+        self.n_spilled_bars += len(rows)
+
+        for name, _ in self._columns:
+            column = getattr(self, name)
+            column[:self.n-k] = column[k:self.n]
+        self.n -= k
+        self.n_completed -= k
+        self.base_minute += k * self.minutes_per_bar
+        self.row_offset += k
+        return k
+
+    def _spill_dtype(self):
+        return np.dtype(list(self._columns))
+
+    def _place(self, t, p, q):
+        if self.t_latest is None or t > self.t_latest:
+            self.t_latest = t
+
+        minute = t // 60
+        if self.base_minute is None:
+            self._set_base_minute(minute)
+
+        i = (minute - self.base_minute) // self.minutes_per_bar
+        if i >= self.n:
+            if i - self.n > _max_empty_rows:
+                self._set_base_minute(minute, self.n)
+                i = (minute - self.base_minute) // self.minutes_per_bar
+            self._extend_to(i)
+            self._fill_bar(i, t, p, q)
+        elif math.isnan(self.opens[i]):
+            self._fill_bar(i, t, p, q)
+        else:
+            self._update_bar(i, t, p, q)
+        if self.t_latest < self._t_next_completion:
+            return ()
+        return self._complete_bars(self._completed_row_count())
+
+    # returns the bars completed by this tick, usually none
     def ingest(self, t, p, q):
-        if t - self.t_latest < -datetime.timedelta(minutes=1, seconds=30):
+        t = timestamps.to_epoch_seconds(t)
+        if self.t_latest is not None and t - self.t_latest < -_max_lateness_seconds:
             # drop old message
-            return
-        self.t_latest = max(self.t_latest, t)
+            self.n_late_dropped += 1
+            return ()
+        for rollup in self.rollups.values():
+            rollup._place(t, p, q)
+        return self._place(t, p, q)
 
-        popped = []
-        t_minutely = t.replace(second=0)
-        while not self.is_empty() and self.bars[-1].t > t_minutely:
-            popped.append(self.bars.pop())
+    def flush(self):
+        # end of stream: treat every remaining bar as completed
+        for rollup in self.rollups.values():
+            rollup.flush()
+        return self._complete_bars(self.n)
 
-        if self.is_empty() or self.bars[-1].t < t_minutely:
-            self._append_bar(t, p, q)
-        else:
-            self.bars[-1].update(t, p, q)
+    def _load(self, first_minute, t_latest, minutes, opens, highs, lows, closes, volumes, gaps=(), **columns):
+        # bulk fill from already aggregated, time-sorted bars, laid out as ingest would.
+        # gaps: (minute of t_latest, minute of the tick) for every tick that moved t_latest more than
+        # _max_empty_rows minutes ahead, in arrival order
+        self._set_base_minute(first_minute)
+        self.t_latest = t_latest
+        self.n = self.n_bars = 0
+        rows = np.empty(len(minutes), dtype=np.int64)
+        start = 0
+        for prev_minute, minute in gaps:
+            if not self._is_gap(prev_minute, minute):
+                continue
+            end = np.searchsorted(minutes, prev_minute, side="right")
+            rows[start:end] = (minutes[start:end] - self.base_minute) // self.minutes_per_bar
+            self._extend_to((prev_minute - self.base_minute) // self.minutes_per_bar)
+            self._set_base_minute(minute, self.n)
+            start = end
+        rows[start:] = (minutes[start:] - self.base_minute) // self.minutes_per_bar
+        self._extend_to(rows[-1])
+        self.opens[rows] = opens
+        self.highs[rows] = highs
+        self.lows[rows] = lows
+        self.closes[rows] = closes
+        self.volumes[rows] = volumes
+        for name, values in columns.items():
+            getattr(self, name)[rows] = values
+        self.n_bars = len(minutes)
 
-        while popped:
-            self.bars.append(popped.pop())
+        if self.rollups:
+            self._load_rollups(first_minute, gaps)
+        return self._complete_bars(self._completed_row_count())
+
+    def _load_rollups(self, first_minute, gaps):
+        rows = np.flatnonzero(~np.isnan(self.opens[:self.n]))
+        minutes = self.minutes[rows]
+        for minutes_per_bar, rollup in self.rollups.items():
+            buckets = minutes // minutes_per_bar
+            starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+            ends = np.r_[starts[1:], len(buckets)] - 1
+            rollup._load(first_minute, self.t_latest, buckets[starts] * minutes_per_bar, self.opens[rows[starts]],
+                         np.maximum.reduceat(self.highs[rows], starts), np.minimum.reduceat(self.lows[rows], starts),
+                         self.closes[rows[ends]], np.add.reduceat(self.volumes[rows], starts),
+                         gaps=gaps, last_seconds=self.last_seconds[rows[ends]], first_minutes=minutes[starts])
 
     def get_latest_bar(self):
         if self.is_empty():
             return None
-        return self.bars[-1]
+        # the newest row always holds the latest tick, so is never empty
+        return Bar(self, self.row_offset + self.n - 1)
+
+    def get_latest_completed_bar(self):
+        if self.i_latest_completed is None:
+            return None
+        return Bar(self, self.i_latest_completed)
+
+    def get_bars(self, start, end):
+        # bars starting in [start, end), spilled and in memory, as a dict of column arrays
+        start_minute = -(-timestamps.to_epoch_seconds(start) // 60)
+        end_minute = -(-timestamps.to_epoch_seconds(end) // 60)
+        parts = []
+        if self.spill_file_name is not None and self.n_spilled_bars:
+            spilled = np.memmap(self.spill_file_name, dtype=self._spill_dtype(), mode="r",
+                                shape=(self.n_spilled_bars,))
+            lo, hi = np.searchsorted(spilled["minutes"], [start_minute, end_minute])
+            parts.append({name: np.array(spilled[name][lo:hi]) for name, _ in self._columns})
+        lo, hi = np.searchsorted(self.minutes[:self.n], [start_minute, end_minute])
+        rows = lo + np.flatnonzero(~np.isnan(self.opens[lo:hi]))
+        parts.append({name: getattr(self, name)[rows] for name, _ in self._columns})
+        return {name: np.concatenate([part[name] for part in parts]) for name, _ in self._columns}
+
+    def as_arrays(self):
+        # zero-copy, read-only views of every column over the rows kept in memory,
+        # empty bars have NaN open/high/low/close and zero volume
+        arrays = {}
+        for name, _ in self._columns:
+            view = getattr(self, name)[:self.n]
+            view.flags.writeable = False
+            arrays[name] = view
+        return arrays
+
+# bars spanning minutes_per_bar minutes, built tick by tick alongside the 1-minute bars.
+# open follows the earliest minute seen in the bar and close the latest second, so late ticks give
+# the same result as rolling up the final 1-minute bars.
+class RollupBarSeries(BarSeries):
+    _columns = BarSeries._columns + (("first_minutes", np.int64),)
+
+    def __init__(self, minutes_per_bar, chunk_size=_chunk_size, retention_minutes=None, spill_file_name=None):
+        self.minutes_per_bar = minutes_per_bar
+        super().__init__(chunk_size=chunk_size, retention_minutes=retention_minutes, spill_file_name=spill_file_name)
+
+    def _extend_to(self, i):
+        n = self.n
+        super()._extend_to(i)
+        self.first_minutes[n:i+1] = self.minutes[n:i+1]
+
+    def _fill_bar(self, i, t, p, q):
+        super()._fill_bar(i, t, p, q)
+        self.first_minutes[i] = t // 60
+
+    def _update_bar(self, i, t, p, q):
+        super()._update_bar(i, t, p, q)
+        minute = t // 60
+        if minute < self.first_minutes[i]:
+            self.opens[i] = p
+            self.first_minutes[i] = minute
+
+def _aggregate_arrays(codes, t, p, q):
+    # group ticks by symbol keeping arrival order within each symbol
+    order = np.argsort(codes, kind="stable")
+    codes, t, p, q = codes[order], t[order], p[order], q[order]
+
+    # running max of t per symbol, offset each symbol into its own range so one accumulate covers all
+    t_min = t.min()
+    span = t.max() - t_min + 1
+    offsets = codes.astype(np.int64) * span
+    t_running_max = np.maximum.accumulate(t - t_min + offsets) - offsets + t_min
+    kept = t - t_running_max >= -_max_lateness_seconds
+    # ticks far enough past t_latest to start a new run of rows, see BarSeries._place
+    prev_minutes, next_minutes = t_running_max[:-1] // 60, t[1:] // 60
+    jumps = 1 + np.flatnonzero((codes[1:] == codes[:-1]) & (next_minutes - prev_minutes - 1 > _max_empty_rows))
+    gap_codes, gaps = codes[jumps], np.stack((prev_minutes[jumps - 1], next_minutes[jumps - 1]), axis=1)
+
+    symbol_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    t_first = t[symbol_starts]
+    t_latest = t_running_max[np.r_[symbol_starts[1:], len(t)] - 1]
+    n_late_dropped = np.bincount(codes[~kept], minlength=len(symbol_starts))
+
+    codes, t, p, q = codes[kept], t[kept], p[kept], q[kept]
+    minutes = t // 60
+    # lexsort is stable, so ticks within a bar stay in arrival order, and with t as the last key
+    # the latest tick of each bar (the last to arrive on a tie) ends it, as BarSeries._update_bar keeps it
+    order = np.lexsort((minutes, codes))
+    by_time = np.lexsort((t, minutes, codes))
+    t_by_time, p_by_time = t[by_time], p[by_time]
+    codes, minutes, p, q = codes[order], minutes[order], p[order], q[order]
+
+    bar_starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (minutes[1:] != minutes[:-1])])
+    bar_ends = np.r_[bar_starts[1:], len(p)]
+    return (t_first, t_latest, n_late_dropped, gap_codes, gaps, codes[bar_starts], minutes[bar_starts], p[bar_starts],
+            np.maximum.reduceat(p, bar_starts), np.minimum.reduceat(p, bar_starts),
+            p_by_time[bar_ends - 1], np.add.reduceat(q, bar_starts), t_by_time[bar_ends - 1])
+
+# async iterator of (symbol, bar) for completed bars, fed on the loop that drives ingestion
+class CompletedBarStream:
+    def __init__(self, aggregator):
+        self._aggregator = aggregator
+        self._queue = asyncio.Queue()
+        aggregator.subscribe(self._on_bar_completed)
+
+    def _on_bar_completed(self, symbol, bar):
+        self._queue.put_nowait((symbol, bar))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+    def close(self):
+        self._aggregator.unsubscribe(self._on_bar_completed)
+
+# dict creating missing entries from the key, unlike defaultdict
+class _SeriesBySymbol(dict):
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, symbol):
+        series = self[symbol] = self.factory(symbol)
+        return series
 
 class Aggregator:
-    def __init__(self):
-        self.bars = collections.defaultdict(BarSeries)
+    # rollups: bar sizes in minutes, e.g. (5, 15, 60, 1440), maintained next to the 1-minute bars
+    # retention_minutes / spill_dir: see BarSeries, each symbol spills to its own file in spill_dir
+    # rejected rows are counted by reason and every reject_log_every-th of each reason is logged
+    def __init__(self, rollups=(), retention_minutes=None, spill_dir=None, reject_log_every=1000):
+        self.rollups = tuple(rollups)
+        self.retention_minutes = retention_minutes
+        self.spill_dir = spill_dir
+        self.bars = _SeriesBySymbol(self._new_series)
+        self.subscribers = []
+        self.reject_log_every = reject_log_every
+        self.n_ingested = 0
+        self.rejections = collections.Counter()
+
+    def _new_series(self, symbol):
+        spill_file_name = None
+        if self.spill_dir is not None:
+            spill_file_name = os.path.join(self.spill_dir, urllib.parse.quote(symbol, safe="") + ".bars")
+        return BarSeries(rollups=self.rollups, retention_minutes=self.retention_minutes,
+                         spill_file_name=spill_file_name)
+
+    def _series(self, symbol, minutes_per_bar):
+        series = self.bars[symbol]
+        return series if minutes_per_bar == 1 else series.rollups[minutes_per_bar]
+
+    def get_latest_bar(self, symbol, minutes_per_bar=1):
+        # the bar still being built, may change with later ticks
+        return self._series(symbol, minutes_per_bar).get_latest_bar()
 
-    def get_latest_bar(self, symbol):
-        return self.bars[symbol].get_latest_bar()
+    def get_latest_completed_bar(self, symbol, minutes_per_bar=1):
+        return self._series(symbol, minutes_per_bar).get_latest_completed_bar()
+
+    def get_bars(self, symbol, start, end, minutes_per_bar=1):
+        return self._series(symbol, minutes_per_bar).get_bars(start, end)
+
+    # callback(symbol, bar) is called once per bar, when the symbol's latest tick has moved
+    # past the lateness limit for that minute
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def stream_completed_bars(self):
+        return CompletedBarStream(self)
+
+    def _publish(self, symbol, bars):
+        for bar in bars:
+            for callback in self.subscribers:
+                callback(symbol, bar)
+
+    def ingest(self, t, s, p, q):
+        # t, p and q may be strings as read from the file, like Engine.ingest_as_stream
+        t, p, q = _parse_tpq(t, p, q)
+        series = self.bars[s]
+        n_late_dropped = series.n_late_dropped
+        self._publish(s, series.ingest(t, p, q))
+        if series.n_late_dropped != n_late_dropped:
+            self._reject("too_late", (t, s, p, q))
+        else:
+            self.n_ingested += 1
+
+    def _reject(self, reason, row, n=1):
+        n_before = self.rejections[reason]
+        self.rejections[reason] += n
+        if (n_before + n - 1) // self.reject_log_every != (n_before - 1) // self.reject_log_every:
+            logger.warning(f"rejected row ({reason}, {self.rejections[reason]} so far): {row}")
+
+    def metrics(self):
+        metrics = {"ingested": self.n_ingested, "rejected": sum(self.rejections.values())}
+        metrics.update({f"rejected_{reason}": n for reason, n in self.rejections.items()})
+        return metrics
+
+    def flush(self):
+        for s, series in self.bars.items():
+            self._publish(s, series.flush())
+
+    def _ingest_rows(self, reader, fieldnames):
+        i_timestamp, i_symbol, i_price, i_quantity = \
+            (fieldnames.index(name) for name in ("timestamp", "symbol", "price", "quantity"))
+        isfinite = math.isfinite
+        for row in reader:
+            try:
+                s, (t, p, q) = row[i_symbol], _parse_tpq(row[i_timestamp], row[i_price], row[i_quantity])
+                valid = isfinite(p) and isfinite(q)
+            except (ValueError, IndexError):
+                valid = False
+            if not valid:
+                self._reject(_rejection_reason(row, i_timestamp, i_price, i_quantity), row)
+                continue
+
+            self.ingest(t, s, p, q)
 
     def aggregate(self, file_name):
-        with open(file_name, "r") as f:
-            reader = csv.DictReader(f)
+        with open(file_name, "r", newline="") as f:
+            reader = csv.reader(f)
+            fieldnames = next(reader, None)
+            if fieldnames is None:
+                return
 
             #rows = [row for row in reader]
-            for row in reader:
-                try:
-                    s, (t, p, q) = row['symbol'], _parse_tpq(row['timestamp'], row['price'], row['quantity'])
-                except Exception as ex:
-                    print(ex)
-                    continue
-
-                self.bars[s].ingest(t, p, q)
+            self._ingest_rows(reader, fieldnames)
+
+    def aggregate_batch(self, file_name):
+        # same bars as aggregate, computed with whole-file array reductions.
+        # series of symbols in the file are rebuilt from scratch.
+        df = pd.read_csv(file_name, dtype=str, keep_default_na=False, usecols=["timestamp", "symbol", "price", "quantity"],
+                         index_col=False)
+        t, t_valid = timestamps.parse_epoch_seconds_array(df["timestamp"].to_numpy())
+        p = pd.to_numeric(df["price"], errors="coerce").to_numpy(dtype=np.float64)
+        q = pd.to_numeric(df["quantity"], errors="coerce").to_numpy(dtype=np.float64)
+        # same precedence as _rejection_reason
+        checks = (("bad_timestamp", t_valid), ("bad_price", np.isfinite(p)), ("bad_quantity", np.isfinite(q)))
+        valid = np.ones(len(df), dtype=bool)
+        for reason, good in checks:
+            bad = valid & ~good
+            if bad.any():
+                self._reject(reason, df.iloc[np.flatnonzero(bad)[0]].tolist(), n=int(bad.sum()))
+                valid &= good
+        if not valid.any():
+            return
+        codes, symbols = pd.factorize(df["symbol"].to_numpy()[valid])
+        self._aggregate_arrays(codes, symbols, t[valid], p[valid], q[valid])
+
+    def replay(self, file_name, batch=False):
+        # binary tick file written by binary_ticks.convert_csv, no parsing needed
+        tick_file = binary_ticks.TickFile(file_name)
+        if batch:
+            if len(tick_file):
+                self._aggregate_arrays(tick_file.symbol_ids, tick_file.symbols, tick_file.timestamps,
+                                       tick_file.prices, tick_file.quantities)
+            return
+        for t, s, p, q in tick_file.iter_ticks():
+            self.ingest(t, s, p, q)
+
+    def _aggregate_arrays(self, codes, symbols, t, p, q):
+        # codes index into symbols
+        t_first, t_latest, n_late_dropped, gap_codes, gaps, bar_codes, minutes, opens, highs, lows, closes, volumes, \
+            last_seconds = _aggregate_arrays(codes, t, p, q)
+        self.n_ingested += len(t) - int(n_late_dropped.sum())
+        if n_late_dropped.any():
+            self._reject("too_late", f"{int(n_late_dropped.sum())} ticks in batch", n=int(n_late_dropped.sum()))
+        # every symbol keeps at least its first tick, so the bars of code i are the i-th run
+        starts = np.flatnonzero(np.r_[True, bar_codes[1:] != bar_codes[:-1]])
+        ends = np.r_[starts[1:], len(bar_codes)]
+        gap_bounds = np.searchsorted(gap_codes, np.arange(len(starts) + 1))
+        for code, (start, end) in enumerate(zip(starts, ends)):
+            series = self._new_series(symbols[code])
+            completed = series._load(int(t_first[code]) // 60, int(t_latest[code]), minutes[start:end], opens[start:end],
+                                     highs[start:end], lows[start:end], closes[start:end], volumes[start:end],
+                                     gaps=gaps[gap_bounds[code]:gap_bounds[code + 1]],
+                                     last_seconds=last_seconds[start:end])
+            series.n_late_dropped = int(n_late_dropped[code])
+            self.bars[symbols[code]] = series
+            self._publish(symbols[code], completed)
+            series._spill_loaded()
+
+
+# Root-level worker so it can be pickled for spawned processes
+def _shard_worker(request_queue, reply_queue, aggregator_kwargs):
+    aggregator = Aggregator(**aggregator_kwargs)
+    while True:
+        kind, payload = request_queue.get()
+        if kind == "lines":
+            fieldnames, lines = payload
+            aggregator._ingest_rows(csv.reader(lines), fieldnames)
+        elif kind == "stop":
+            break
+        else:
+            # queries, e.g. ("get_latest_bar", (symbol, minutes_per_bar)), a failing one is raised in the parent
+            try:
+                reply_queue.put(("ok", getattr(aggregator, kind)(*payload)))
+            except Exception as exc:
+                reply_queue.put(("error", exc))
+
+# Aggregator split over worker processes by symbol hash. Raw csv lines are routed in batches
+# so that parsing happens in the workers too; queries go to the owning shard.
+class ShardedAggregator:
+    # aggregator_kwargs are passed to the Aggregator of every shard
+    def __init__(self, n_shards=None, batch_size=4096, max_pending_batches=16, **aggregator_kwargs):
+        self.n_shards = n_shards or os.cpu_count()
+        self.batch_size = batch_size
+        self.fieldnames = None
+        self.pending = [[] for _ in range(self.n_shards)]
+        # bounded so a slow shard pushes back on the reader instead of buffering the file
+        self.request_queues = [multiprocessing.Queue(max_pending_batches) for _ in range(self.n_shards)]
+        self.reply_queues = [multiprocessing.Queue() for _ in range(self.n_shards)]
+        self.processes = [multiprocessing.Process(target=_shard_worker, args=(request_queue, reply_queue, aggregator_kwargs),
+                                                  daemon=True)
+                          for request_queue, reply_queue in zip(self.request_queues, self.reply_queues)]
+        for process in self.processes:
+            process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _shard(self, symbol):
+        # crc32 rather than hash() so routing does not depend on PYTHONHASHSEED
+        return zlib.crc32(symbol.encode()) % self.n_shards
+
+    def _check_alive(self, i):
+        if not self.processes[i].is_alive():
+            raise RuntimeError(f"shard {i} worker exited with code {self.processes[i].exitcode}")
+
+    def _put(self, i, request):
+        # a dead worker would leave a full queue blocked for good
+        while True:
+            try:
+                return self.request_queues[i].put(request, timeout=_shard_poll_seconds)
+            except queue.Full:
+                self._check_alive(i)
+
+    def _get(self, i):
+        while True:
+            try:
+                status, value = self.reply_queues[i].get(timeout=_shard_poll_seconds)
+                break
+            except queue.Empty:
+                self._check_alive(i)
+        if status == "error":
+            raise value
+        return value
+
+    def _send(self, i):
+        if self.pending[i]:
+            self._put(i, ("lines", (self.fieldnames, self.pending[i])))
+            self.pending[i] = []
+
+    def _query(self, kind, symbol, *args):
+        i = self._shard(symbol)
+        self._send(i)
+        self._put(i, (kind, (symbol, *args)))
+        return self._get(i)
+
+    def get_latest_bar(self, symbol, minutes_per_bar=1):
+        return self._query("get_latest_bar", symbol, minutes_per_bar)
+
+    def get_latest_completed_bar(self, symbol, minutes_per_bar=1):
+        return self._query("get_latest_completed_bar", symbol, minutes_per_bar)
+
+    def get_bars(self, symbol, start, end, minutes_per_bar=1):
+        return self._query("get_bars", symbol, start, end, minutes_per_bar)
+
+    def metrics(self):
+        # summed over shards, each shard first drains its pending lines
+        metrics = collections.Counter()
+        for i in range(self.n_shards):
+            self._send(i)
+            self._put(i, ("metrics", ()))
+        for i in range(self.n_shards):
+            metrics.update(self._get(i))
+        return dict(metrics)
+
+    def aggregate(self, file_name):
+        with open(file_name, "r", newline="") as f:
+            header = next(csv.reader([f.readline()]))
+            if self.fieldnames is None:
+                self.fieldnames = header
+            assert header == self.fieldnames, f"{header=} differs from {self.fieldnames=}"
+            i_symbol = header.index("symbol")
+
+            for line in f:
+                if '"' in line:
+                    # quoted fields, split the way the worker's csv.reader will
+                    fields = next(csv.reader([line]), [])
+                else:
+                    fields = line.rstrip("\r\n").split(",", i_symbol + 1)
+                # short lines are malformed, the worker of shard 0 reports them
+                i = self._shard(fields[i_symbol]) if len(fields) > i_symbol else 0
+                self.pending[i].append(line)
+                if len(self.pending[i]) >= self.batch_size:
+                    self._send(i)
+
+        for i in range(self.n_shards):
+            self._send(i)
+
+    def close(self):
+        try:
+            for i in range(self.n_shards):
+                self._send(i)
+                self._put(i, ("stop", None))
+        except BaseException:
+            # a shard died, the others would never get their stop
+            for process in self.processes:
+                process.terminate()
+            raise
+        finally:
+            for process in self.processes:
+                process.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+import csv
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import binary_ticks
+import tick_aggregator
+import timestamps
+
+
+# list-of-bars BarSeries with pop/re-push late tick handling, kept as the baseline to compare against
+class _ListBar:
+    def __init__(self, t, p, q):
+        self.t = t
+        self.o = self.h = self.l = self.c = p
+        self.q = q
+
+    def update(self, p, q):
+        self.h = max(self.h, p)
+        self.l = min(self.l, p)
+        self.c = p
+        self.q += q
+
+class _ListBarSeries:
+    def __init__(self):
+        self.t_latest = datetime.datetime.fromtimestamp(0)
+        self.bars = []
+
+    def ingest(self, t, p, q):
+        if t - self.t_latest < -datetime.timedelta(seconds=tick_aggregator._max_lateness_seconds):
+            return
+        self.t_latest = max(self.t_latest, t)
+
+        popped = []
+        t_minutely = t.replace(second=0)
+        while self.bars and self.bars[-1].t > t_minutely:
+            popped.append(self.bars.pop())
+
+        if not self.bars or self.bars[-1].t < t_minutely:
+            self.bars.append(_ListBar(t_minutely, p, q))
+        else:
+            self.bars[-1].update(p, q)
+
+        while popped:
+            self.bars.append(popped.pop())
+
+
+def generate_shuffled_ticks(n_ticks, ticks_per_minute=20, max_lateness_seconds=60, seed=0):
+    # ticks in time order, then displaced backwards by up to max_lateness_seconds worth of ticks
+    rng = random.Random(seed)
+    t0 = datetime.datetime(2024, 7, 1, 9, 30)
+    step = 60 / ticks_per_minute
+    ticks = [(t0 + datetime.timedelta(seconds=int(i * step)), rng.uniform(100, 200), float(rng.randint(1, 500)))
+             for i in range(n_ticks)]
+    window = max(1, int(max_lateness_seconds / step))
+    keys = [i + rng.uniform(0, window) for i in range(n_ticks)]
+    return [tick for _, tick in sorted(zip(keys, ticks), key=lambda kt: kt[0])]
+
+
+def measure_throughput(series_factory, ticks, convert=None, repeat=3):
+    if convert:
+        ticks = [(convert(t), p, q) for t, p, q in ticks]
+    best = None
+    for _ in range(repeat):
+        series = series_factory()
+        t1 = time.perf_counter()
+        for t, p, q in ticks:
+            series.ingest(t, p, q)
+        elapsed = time.perf_counter() - t1
+        best = elapsed if best is None else min(best, elapsed)
+    return len(ticks) / best
+
+
+def benchmark_late_tick_placement(n_ticks=200_000):
+    print(f"=== shuffled tick ingest, {n_ticks} ticks ===")
+    for ticks_per_minute in (5, 60, 600):
+        ticks = generate_shuffled_ticks(n_ticks, ticks_per_minute=ticks_per_minute)
+        list_rate = measure_throughput(_ListBarSeries, ticks)
+        columnar_rate = measure_throughput(tick_aggregator.BarSeries, ticks,
+                                           convert=timestamps.to_epoch_seconds)
+        print(f"{ticks_per_minute} ticks/min: list pop/re-push: {list_rate:,.0f} ticks/s, "
+              f"offset placement: {columnar_rate:,.0f} ticks/s")
+
+
+def write_ticks_csv(file_name, n_ticks_per_symbol, symbols, ticks_per_minute=20, seed=0):
+    rows = []
+    for i, symbol in enumerate(symbols):
+        for t, p, q in generate_shuffled_ticks(n_ticks_per_symbol, ticks_per_minute=ticks_per_minute, seed=seed + i):
+            rows.append((t, symbol, round(p, 2), int(q)))
+    # interleave symbols roughly in time order, keeping each symbol's own shuffle
+    rows.sort(key=lambda row: row[0].replace(second=0))
+    with open(file_name, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["timestamp", "symbol", "price", "quantity"])
+        for t, symbol, p, q in rows:
+            writer.writerow([t.strftime(timestamps.datetime_format), symbol, p, q])
+
+
+def benchmark_batch_aggregate(n_ticks_per_symbol=20_000, n_symbols=50):
+    print(f"=== aggregate vs aggregate_batch, {n_ticks_per_symbol * n_symbols} ticks ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "ticks.csv")
+        write_ticks_csv(file_name, n_ticks_per_symbol, [f"S{i:04d}" for i in range(n_symbols)])
+        for method in ("aggregate", "aggregate_batch"):
+            aggregator = tick_aggregator.Aggregator()
+            t1 = time.perf_counter()
+            getattr(aggregator, method)(file_name)
+            print(f"{method}: {time.perf_counter() - t1:.3f}s")
+
+
+def benchmark_sharded_aggregate(n_ticks_per_symbol=5_000, n_symbols=200):
+    n_cores = os.cpu_count()
+    print(f"=== Aggregator vs ShardedAggregator, {n_ticks_per_symbol * n_symbols} ticks, {n_cores} cores ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "ticks.csv")
+        write_ticks_csv(file_name, n_ticks_per_symbol, [f"S{i:04d}" for i in range(n_symbols)])
+
+        t1 = time.perf_counter()
+        tick_aggregator.Aggregator().aggregate(file_name)
+        print(f"Aggregator: {time.perf_counter() - t1:.3f}s")
+
+        for n_shards in sorted({1, 2, 4, n_cores}):
+            t1 = time.perf_counter()
+            # closing waits for the workers to drain their queues
+            with tick_aggregator.ShardedAggregator(n_shards=n_shards) as aggregator:
+                aggregator.aggregate(file_name)
+            print(f"ShardedAggregator({n_shards}): {time.perf_counter() - t1:.3f}s")
+
+
+def benchmark_binary_replay(n_ticks_per_symbol=20_000, n_symbols=50):
+    print(f"=== csv vs binary tick file, {n_ticks_per_symbol * n_symbols} ticks ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_name = os.path.join(tmp_dir, "ticks.csv")
+        binary_file_name = os.path.join(tmp_dir, "ticks.bin")
+        write_ticks_csv(csv_file_name, n_ticks_per_symbol, [f"S{i:04d}" for i in range(n_symbols)])
+        t1 = time.perf_counter()
+        binary_ticks.convert_csv(csv_file_name, binary_file_name)
+        print(f"convert_csv: {time.perf_counter() - t1:.3f}s")
+
+        for label, run in (("aggregate", lambda a: a.aggregate(csv_file_name)),
+                           ("replay", lambda a: a.replay(binary_file_name)),
+                           ("aggregate_batch", lambda a: a.aggregate_batch(csv_file_name)),
+                           ("replay(batch=True)", lambda a: a.replay(binary_file_name, batch=True))):
+            t1 = time.perf_counter()
+            run(tick_aggregator.Aggregator())
+            print(f"{label}: {time.perf_counter() - t1:.3f}s")
+
+
+def benchmark_rollups(n_ticks=200_000, rollups=(5, 15, 60, 1440)):
+    print(f"=== 1m bars with {rollups} rollups, {n_ticks} ticks ===")
+    ticks = generate_shuffled_ticks(n_ticks)
+    rate_1m = measure_throughput(tick_aggregator.BarSeries, ticks, convert=timestamps.to_epoch_seconds)
+    rate_rollups = measure_throughput(lambda: tick_aggregator.BarSeries(rollups=rollups), ticks,
+                                      convert=timestamps.to_epoch_seconds)
+    # a separate pass per resolution costs about one 1m pass each
+    print(f"1m only: {rate_1m:,.0f} ticks/s, {len(rollups) + 1} separate passes: {rate_1m / (len(rollups) + 1):,.0f} ticks/s, "
+          f"incremental rollups: {rate_rollups:,.0f} ticks/s")
+
+
+def benchmark_dirty_feed(n_ticks_per_symbol=20_000, n_symbols=10, garbage_ratio=0.05):
+    print(f"=== aggregate on a clean feed vs one with {garbage_ratio:.0%} malformed rows ===")
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clean_file_name = os.path.join(tmp_dir, "clean.csv")
+        dirty_file_name = os.path.join(tmp_dir, "dirty.csv")
+        write_ticks_csv(clean_file_name, n_ticks_per_symbol, [f"S{i:04d}" for i in range(n_symbols)])
+        with open(clean_file_name) as src, open(dirty_file_name, "w") as dst:
+            dst.write(src.readline())
+            for line in src:
+                if rng.random() < garbage_ratio:
+                    # an extra trailing field is read by position and still ingested
+                    line = rng.choice(["not-a-time,S0000,1.0,1\n", "2024-07-01T10:00:00Z,S0000,abc,1\n",
+                                       "2024-07-01T10:00:00Z,S0000\n", line.rstrip("\r\n") + ",extra\n"])
+                dst.write(line)
+
+        for file_name in (clean_file_name, dirty_file_name):
+            aggregator = tick_aggregator.Aggregator()
+            t1 = time.perf_counter()
+            aggregator.aggregate(file_name)
+            t2 = time.perf_counter()
+            batch_aggregator = tick_aggregator.Aggregator()
+            batch_aggregator.aggregate_batch(file_name)
+            t3 = time.perf_counter()
+            assert aggregator.metrics() == batch_aggregator.metrics(), (aggregator.metrics(), batch_aggregator.metrics())
+            print(f"{os.path.basename(file_name)}: aggregate {t2 - t1:.3f}s, aggregate_batch {t3 - t2:.3f}s, "
+                  f"same metrics: {aggregator.metrics()}")
+
+
+if __name__ == "__main__":
+    benchmark_late_tick_placement()
+    benchmark_batch_aggregate()
+    benchmark_sharded_aggregate()
+    benchmark_binary_replay()
+    benchmark_rollups()
+    benchmark_dirty_feed()
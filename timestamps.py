@@ -0,0 +1,101 @@
+import datetime
+import numpy as np
+
+# fixed layout shared by the tick and trade files: YYYY-MM-DDTHH:MM:SSZ, UTC
+datetime_format = "%Y-%m-%dT%H:%M:%SZ"
+_length = 20
+_epoch = datetime.datetime(1970, 1, 1)
+_epoch_ordinal = _epoch.toordinal()
+
+# 'YYYY-MM-DD' -> epoch seconds at midnight, files rarely span more than a handful of dates
+_day_seconds_cache = {}
+
+
+def _day_seconds(date_prefix):
+    day_seconds = _day_seconds_cache.get(date_prefix)
+    if day_seconds is None:
+        if date_prefix[4] != "-" or date_prefix[7] != "-" or \
+                not (date_prefix[0:4] + date_prefix[5:7] + date_prefix[8:10]).isdigit():
+            raise ValueError(f"malformed date: {date_prefix!r}")
+        date = datetime.date(int(date_prefix[0:4]), int(date_prefix[5:7]), int(date_prefix[8:10]))
+        day_seconds = (date.toordinal() - _epoch_ordinal) * 86400
+        _day_seconds_cache[date_prefix] = day_seconds
+    return day_seconds
+
+
+def parse_epoch_seconds(s):
+    # stricter than strptime: every field must be exactly two (four for the year) ascii digits
+    if len(s) != _length or not s.isascii() or s[10] != "T" or s[13] != ":" or s[16] != ":" or s[19] != "Z" or \
+            not (s[11:13] + s[14:16] + s[17:19]).isdigit():
+        raise ValueError(f"time data {s!r} does not match format {datetime_format!r}")
+    hour, minute, second = int(s[11:13]), int(s[14:16]), int(s[17:19])
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise ValueError(f"time data {s!r} out of range")
+    return _day_seconds(s[:10]) + hour * 3600 + minute * 60 + second
+
+
+def parse_epoch_minutes(s):
+    return parse_epoch_seconds(s) // 60
+
+
+def parse_datetime(s):
+    # naive UTC datetime, same as datetime.strptime(s, datetime_format)
+    return _epoch + datetime.timedelta(seconds=parse_epoch_seconds(s))
+
+
+def to_epoch_seconds(t):
+    if isinstance(t, datetime.datetime):
+        return (t - _epoch) // datetime.timedelta(seconds=1)
+    return int(t)
+
+
+def from_epoch_seconds(seconds):
+    return _epoch + datetime.timedelta(seconds=int(seconds))
+
+
+def _days_from_civil(y, m, d):
+    # proleptic Gregorian date -> days since 1970-01-01, vectorized over arrays
+    y = y - (m <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * np.where(m > 2, m - 3, m + 9) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def parse_epoch_seconds_array(values):
+    # bulk parse of a string array, returns (epoch seconds int64, valid mask)
+    # anything but a 20 character str becomes a placeholder that fails the separator checks,
+    # non-ascii characters become "?" so every row is exactly _length bytes
+    values = np.asarray(values, dtype=object).tolist()
+    if set(map(type, values)) - {str} or set(map(len, values)) - {_length}:
+        invalid = "?" * _length
+        values = [v if type(v) is str and len(v) == _length else invalid for v in values]
+    chars = np.frombuffer("".join(values).encode("ascii", "replace"), dtype=np.uint8).reshape(len(values), _length)
+
+    separators = {4: "-", 7: "-", 10: "T", 13: ":", 16: ":", 19: "Z"}
+    valid = np.ones(len(values), dtype=bool)
+    for i, separator in separators.items():
+        valid &= chars[:, i] == ord(separator)
+    # uint8 wraps below "0", so a single upper bound checks every digit
+    digits = chars - np.uint8(ord("0"))
+    digit_columns = [i for i in range(_length) if i not in separators]
+    valid &= (digits[:, digit_columns] <= 9).all(axis=1)
+
+    def number(start, end):
+        n = digits[:, start].astype(np.int64)
+        for i in range(start + 1, end):
+            n = n * 10 + digits[:, i]
+        return n
+
+    y, m, d = number(0, 4), number(5, 7), number(8, 10)
+    hour, minute, second = number(11, 13), number(14, 16), number(17, 19)
+    days_in_month = np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(m - 1, 0, 11)]
+    leap = (y % 4 == 0) & ((y % 100 != 0) | (y % 400 == 0))
+    days_in_month = np.where((m == 2) & ~leap, 28, days_in_month)
+    valid &= (y >= 1) & (1 <= m) & (m <= 12) & (1 <= d) & (d <= days_in_month)
+    valid &= (hour < 24) & (minute < 60) & (second < 60)
+
+    seconds = _days_from_civil(y, m, d) * 86400 + hour * 3600 + minute * 60 + second
+    seconds[~valid] = 0
+    return seconds, valid
@@ -0,0 +1,45 @@
+import datetime
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+import timestamps
+
+
+def generate_timestamps(n, n_days=3, seed=0):
+    rng = random.Random(seed)
+    t0 = datetime.datetime(2024, 7, 1)
+    return [(t0 + datetime.timedelta(seconds=rng.randrange(n_days * 86400))).strftime(timestamps.datetime_format)
+            for _ in range(n)]
+
+
+def measure(label, func, values, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        func(values)
+        elapsed = time.perf_counter() - t1
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label}: {best:.3f}s, {len(values) / best:,.0f} rows/s")
+
+
+def benchmark_scalar(n=500_000):
+    print(f"=== per-row parsing, {n} rows ===")
+    values = generate_timestamps(n)
+    measure("datetime.strptime", lambda vs: [datetime.datetime.strptime(v, timestamps.datetime_format) for v in vs], values)
+    measure("timestamps.parse_datetime", lambda vs: [timestamps.parse_datetime(v) for v in vs], values)
+    measure("timestamps.parse_epoch_seconds", lambda vs: [timestamps.parse_epoch_seconds(v) for v in vs], values)
+
+
+def benchmark_bulk(n=1_000_000):
+    print(f"=== bulk parsing, {n} rows ===")
+    values = np.array(generate_timestamps(n), dtype=object)
+    measure("pd.to_datetime", lambda vs: pd.to_datetime(vs, format=timestamps.datetime_format), values)
+    measure("timestamps.parse_epoch_seconds_array", timestamps.parse_epoch_seconds_array, values)
+
+
+if __name__ == "__main__":
+    benchmark_scalar()
+    benchmark_bulk()
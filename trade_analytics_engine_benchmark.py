@@ -0,0 +1,332 @@
+import asyncio
+import contextlib
+import csv
+import datetime
+import io
+import math
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import timestamps
+import trade_analytics_engine_practice
+import trade_analytics_service
+
+
+def generate_trades(n_trades, symbols=("AAPL", "GOOG", "MSFT"), trades_per_minute=20, max_lateness_seconds=120, seed=0):
+    # (t, symbol, price, quantity) roughly in time order, with some trades arriving late
+    rng = random.Random(seed)
+    t0 = datetime.datetime(2024, 7, 1, 9, 30)
+    step = 60 / trades_per_minute
+    trades = []
+    for i in range(n_trades):
+        t = t0 + datetime.timedelta(seconds=int(i * step) - rng.randint(0, max_lateness_seconds))
+        trades.append((t, rng.choice(symbols), round(rng.uniform(100, 200), 2), float(rng.randint(1, 500))))
+    return trades
+
+
+def measure_throughput(engine_factory, trades, repeat=3):
+    best = None
+    for _ in range(repeat):
+        engine = engine_factory()
+        t1 = time.perf_counter()
+        for t, s, p, q in trades:
+            engine.ingest_as_stream(t, s, p, q)
+        elapsed = time.perf_counter() - t1
+        best = elapsed if best is None else min(best, elapsed)
+    return len(trades) / best
+
+
+def benchmark_vwap_window_size(n_trades=100_000):
+    print(f"=== ingest_as_stream by vwap window, {n_trades} trades ===")
+    trades = generate_trades(n_trades)
+    for window in (5, 15, 60):
+        rate = measure_throughput(lambda: trade_analytics_engine_practice.Engine(
+            vwap_window_size_minutes=window, grace_period_minutes=3), trades)
+        print(f"{window} minute vwap: {rate:,.0f} trades/s")
+
+
+
+def benchmark_rolling_statistics(n_trades=100_000, window_sizes=(1, 5, 15, 60)):
+    print(f"=== {len(window_sizes)} vwap windows, side by side Engines vs one RollingEngine, {n_trades} trades ===")
+    trades = generate_trades(n_trades)
+    # one Engine per window has to see every trade
+    rates = [measure_throughput(lambda: trade_analytics_engine_practice.Engine(
+        vwap_window_size_minutes=window, grace_period_minutes=3), trades) for window in window_sizes]
+    print(f"{len(window_sizes)} Engines: {1 / sum(1 / rate for rate in rates):,.0f} trades/s")
+    for statistics in ({"vwap": window_sizes}, trade_analytics_engine_practice.RollingEngine.default_statistics):
+        rate = measure_throughput(lambda: trade_analytics_engine_practice.RollingEngine(
+            statistics=statistics, grace_period_minutes=3), trades)
+        print(f"RollingEngine({sorted(statistics)}): {rate:,.0f} trades/s")
+
+
+def write_trades_csv(file_name, trades):
+    with open(file_name, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["timestamp", "symbol", "side", "price", "quantity"])
+        for t, s, p, q in trades:
+            writer.writerow([t.strftime(timestamps.datetime_format), s, "BUY", p, int(q)])
+
+
+def assert_batch_matches_stream(average_trade_size, vwaps, df_average_trade_size, df_vwaps):
+    assert set(average_trade_size) == set(df_average_trade_size.index)
+    for s, vs in vwaps.items():
+        assert math.isclose(average_trade_size[s], df_average_trade_size.loc[s, "quantity"], rel_tol=1e-12)
+        rows = df_vwaps.loc[s]
+        vs = [v for v in vs if v is not None]
+        assert len(vs) == len(rows), f"{s}: {len(vs)} streamed minutes, {len(rows)} batch minutes"
+        for (t, vwap), t_batch, vwap_batch in zip(vs, rows.index, rows.vwap):
+            assert t == t_batch, f"{s}: {t} != {t_batch}"
+            assert math.isnan(vwap_batch) if vwap is None else math.isclose(vwap, vwap_batch, rel_tol=1e-12), \
+                f"{s} {t}: {vwap} != {vwap_batch}"
+
+
+def benchmark_batch_vs_stream(n_trades=200_000, n_symbols=100):
+    print(f"=== analyze_file vs analyze_file_as_dataframe, {n_trades} trades ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "trades.csv")
+        write_trades_csv(file_name, generate_trades(n_trades, symbols=[f"S{i:03d}" for i in range(n_symbols)],
+                                                    trades_per_minute=200, max_lateness_seconds=300))
+        for file_name in (os.path.join(os.path.dirname(__file__), "bam_quant_dev_mock", "trades.csv"), file_name):
+            t1 = time.perf_counter()
+            # the late drop messages would dominate the timing, the whole history is kept to compare it
+            with contextlib.redirect_stdout(io.StringIO()):
+                average_trade_size, vwaps = trade_analytics_engine_practice.Engine(
+                    retention_minutes=n_trades).analyze_file(file_name)
+            t2 = time.perf_counter()
+            df_average_trade_size, df_vwaps = trade_analytics_engine_practice.Engine().analyze_file_as_dataframe(file_name)
+            t3 = time.perf_counter()
+            assert_batch_matches_stream(average_trade_size, vwaps, df_average_trade_size, df_vwaps)
+            print(f"{os.path.basename(file_name)}: analyze_file {t2 - t1:.3f}s, "
+                  f"analyze_file_as_dataframe {t3 - t2:.3f}s, {(t2 - t1) / (t3 - t2):.0f}x, results match")
+
+
+def benchmark_many_symbols(n_symbols=10_000, n_trades=200_000):
+    print(f"=== ingest_as_stream over {n_symbols} symbols, {n_trades} trades ===")
+    trades = generate_trades(n_trades, symbols=[f"S{i:05d}" for i in range(n_symbols)],
+                             trades_per_minute=3 * n_symbols, max_lateness_seconds=60)
+    print(f"{measure_throughput(trade_analytics_engine_practice.Engine, trades):,.0f} trades/s")
+
+    # one trade per symbol, so the vwap output is a single minute and the state dominates
+    t = datetime.datetime(2024, 7, 1, 9, 30)
+    tracemalloc.start()
+    engine = trade_analytics_engine_practice.Engine()
+    for i in range(n_symbols):
+        engine.ingest_as_stream(t, f"S{i:05d}", 100.0, 1.0)
+    print(f"{tracemalloc.get_traced_memory()[0] / n_symbols:,.0f} bytes per symbol")
+    tracemalloc.stop()
+
+
+def benchmark_vwap_history(n_symbols=100, n_days=3, retention_minutes=390):
+    print(f"=== vwap history over {n_days} days of {n_symbols} symbols, {retention_minutes} minutes retained ===")
+    engine = trade_analytics_engine_practice.Engine(retention_minutes=retention_minutes)
+    tracemalloc.start()
+    for day in range(n_days):
+        # one trade per symbol per minute, so every minute of the day has a vwap
+        trades = generate_trades(n_symbols * 24 * 60, symbols=[f"S{i:03d}" for i in range(n_symbols)],
+                                 trades_per_minute=n_symbols, max_lateness_seconds=0, seed=day)
+        for t, s, p, q in trades:
+            engine.ingest_as_stream(t + datetime.timedelta(days=day), s, p, q)
+        del trades
+        print(f"after day {day + 1}: {tracemalloc.get_traced_memory()[0] / 1e6:.1f}MB")
+    tracemalloc.stop()
+
+    t_last = max(t for t, _ in engine.vwap_range("S000", datetime.datetime.min, datetime.datetime.max))
+    minutes = [t_last - datetime.timedelta(minutes=i % retention_minutes) for i in range(100_000)]
+    t1 = time.perf_counter()
+    for t in minutes:
+        engine.vwap_at("S000", t)
+    print(f"vwap_at: {(time.perf_counter() - t1) / len(minutes) * 1e6:.2f}us")
+    t1 = time.perf_counter()
+    engine.vwap_range("S000", t_last - datetime.timedelta(minutes=60), t_last)
+    print(f"vwap_range over 60 minutes: {(time.perf_counter() - t1) * 1e6:.0f}us")
+
+
+def benchmark_snapshot_restore(n_trades=1_000_000, n_symbols=500, tail_fraction=0.01):
+    print(f"=== restart from a snapshot vs a full replay, {n_trades} trades over {n_symbols} symbols ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "trades.csv")
+        snapshot_file_name = os.path.join(tmp_dir, "engine.snapshot")
+        write_trades_csv(file_name, generate_trades(n_trades, symbols=[f"S{i:03d}" for i in range(n_symbols)],
+                                                    trades_per_minute=1_000))
+        with open(file_name, "rb") as f:
+            data = f.read()
+        # the process went down with the last tail_fraction of the file not yet ingested
+        cut = data.rfind(b"\n", 0, int(len(data) * (1 - tail_fraction))) + 1
+        head_file_name = os.path.join(tmp_dir, "head.csv")
+        with open(head_file_name, "wb") as f:
+            f.write(data[:cut])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            t1 = time.perf_counter()
+            full = trade_analytics_engine_practice.Engine()
+            full.ingest_file(file_name, follow=False)
+            t2 = time.perf_counter()
+            engine = trade_analytics_engine_practice.Engine()
+            engine.snapshot(snapshot_file_name, engine.ingest_file(head_file_name))
+            t3 = time.perf_counter()
+            engine.snapshot(snapshot_file_name, cut)
+            t4 = time.perf_counter()
+            engine, offset = trade_analytics_engine_practice.Engine.restore(snapshot_file_name)
+            t5 = time.perf_counter()
+            engine.ingest_file(file_name, offset, follow=False)
+            t6 = time.perf_counter()
+        assert engine.vwaps == full.vwaps and engine.average_trade_size == full.average_trade_size
+        print(f"full replay: {t2 - t1:.3f}s, snapshot: {t4 - t3:.3f}s and {os.path.getsize(snapshot_file_name) / 1e6:.1f}MB, "
+              f"restore: {t5 - t4:.3f}s + {tail_fraction:.0%} tail: {t6 - t5:.3f}s, results match")
+
+
+def benchmark_trade_store(n_trades=10_000_000, n_symbols=1_000, batch_size=1_000_000, n_scans=10_000):
+    print(f"=== TradeStore, {n_trades} trades over {n_symbols} symbols ===")
+    # numpy columns straight away, generate_trades would take longer than the store
+    rng = np.random.default_rng(0)
+    t0 = timestamps.to_epoch_seconds(datetime.datetime(2024, 7, 1, 9, 30))
+    store = trade_analytics_engine_practice.TradeStore()
+    symbol_ids = np.array([store.symbol_id(f"S{i:04d}") for i in range(n_symbols)], dtype=np.int32)
+    tracemalloc.start()
+    t1 = time.perf_counter()
+    for start in range(0, n_trades, batch_size):
+        # a trade per symbol every few seconds, 1% of them up to 2 minutes late
+        seconds = t0 + np.arange(start, start + batch_size) * n_symbols // 3_000
+        seconds -= (rng.random(batch_size) < 0.01) * rng.integers(0, 120, batch_size)
+        store.extend(seconds, symbol_ids[rng.integers(0, n_symbols, batch_size)],
+                     rng.choice(np.array([1, -1], dtype=np.int8), batch_size),
+                     rng.uniform(100, 200, batch_size).round(2), rng.integers(1, 500, batch_size).astype(np.float64))
+    elapsed = time.perf_counter() - t1
+    size = tracemalloc.get_traced_memory()[0]
+    store.compact()
+    compact_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"extend: {n_trades / elapsed:,.0f} trades/s, {size / n_trades:.1f} bytes per trade, "
+          f"{compact_size / n_trades:.1f} after compact(), {compact_size / n_trades * 1e8 / 2 ** 30:.1f}GB at 100M trades")
+
+    t_last = int(seconds[-1])
+    queries = [(f"S{rng.integers(n_symbols):04d}", int(t)) for t in rng.integers(t0, t_last, n_scans)]
+    t1 = time.perf_counter()
+    for s, t in queries:
+        store.scan(s, t, t + 300)
+    print(f"scan of 5 minutes: {(time.perf_counter() - t1) / n_scans * 1e6:.1f}us")
+    t1 = time.perf_counter()
+    for s, t in queries:
+        store.volume(s, t, t + 300, side="BUY")
+    print(f"buy volume over 5 minutes: {(time.perf_counter() - t1) / n_scans * 1e6:.1f}us")
+
+    # live: a trade up to 2 minutes late, then the last 5 minutes of its symbol
+    t1 = time.perf_counter()
+    for s, _ in queries:
+        store.append(t_last - int(rng.integers(0, 120)), s, 1, 150.0, 1.0)
+        store.scan(s, t_last - 300, t_last)
+    print(f"late append and scan of the last 5 minutes: {(time.perf_counter() - t1) / n_scans * 1e6:.1f}us")
+
+
+async def _run_service(trades, rate, n_sources, subscriber_delay_seconds):
+    latencies = []
+
+    async def consume(stream):
+        async for update in stream:
+            latencies.append(time.perf_counter() - update.received)
+            if subscriber_delay_seconds:
+                await asyncio.sleep(subscriber_delay_seconds)
+
+    async def feed_queue(queue):
+        # an in-process source, fed by the pacer below
+        while (trade := await queue.get()) is not None:
+            yield trade
+
+    async with trade_analytics_service.TradeService(max_pending_trades=4096) as service:
+        consumer = asyncio.create_task(consume(service.subscribe(maxsize=256)))
+        server = await service.serve_socket()
+        _, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        queues = [asyncio.Queue(1024) for _ in range(n_sources - 1)]
+        feeders = [asyncio.create_task(service.feed(feed_queue(queue))) for queue in queues]
+
+        # half the trades through the socket, the rest spread over the in-process sources
+        t1 = time.perf_counter()
+        for i, (t, s, p, q) in enumerate(trades):
+            if i % 2 == 0:
+                writer.write(f"{t.strftime(timestamps.datetime_format)},{s},BUY,{p},{int(q)}\n".encode())
+                await writer.drain()
+            else:
+                await queues[i % len(queues)].put((t, s, p, q))
+            # paced in 1ms steps, waiting out the ones already gone
+            if i % max(1, rate // 1000) == 0:
+                await asyncio.sleep(max(0.0, t1 + i / rate - time.perf_counter()))
+        for queue in queues:
+            await queue.put(None)
+        await asyncio.gather(*feeders)
+        writer.close()
+        await writer.wait_closed()
+        while service.n_trades < len(trades):
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - t1
+        server.close()
+    await consumer
+    return service, latencies, elapsed
+
+
+def benchmark_service_latency(n_trades=100_000, n_symbols=100, n_sources=4):
+    print(f"=== TradeService, {n_trades} trades from a socket and {n_sources - 1} queues, {n_symbols} symbols ===")
+    trades = generate_trades(n_trades, symbols=[f"S{i:03d}" for i in range(n_symbols)], trades_per_minute=200)
+    for rate, subscriber_delay_seconds in ((10_000, 0), (50_000, 0), (10_000, 0.0005)):
+        service, latencies, elapsed = asyncio.run(_run_service(trades, rate, n_sources, subscriber_delay_seconds))
+        latencies.sort()
+        p50, p99 = (latencies[int(len(latencies) * f)] * 1e3 for f in (0.5, 0.99))
+        print(f"offered {rate:,} trades/s, subscriber delay {subscriber_delay_seconds * 1e3:.1f}ms: "
+              f"{n_trades / elapsed:,.0f} trades/s, {service.n_trades / service.n_batches:.0f} trades/batch, "
+              f"update latency p50 {p50:.2f}ms p99 {p99:.2f}ms")
+
+
+async def _close_while_feeding(trades):
+    accepted = []
+    updates = []
+
+    async def feed(service):
+        for trade in trades:
+            await service.put(trade)
+            accepted.append(trade)
+            await asyncio.sleep(0)
+
+    async def consume(stream):
+        async for update in stream:
+            updates.append(update)
+
+    service = await trade_analytics_service.TradeService(batch_size=16, max_pending_trades=8).start()
+    consumer = asyncio.create_task(consume(service.subscribe()))
+    feeder = asyncio.create_task(feed(service))
+    while len(accepted) < len(trades) // 2:
+        await asyncio.sleep(0)
+    await service.close()
+    try:
+        await feeder
+    except RuntimeError:
+        pass
+    # the subscriber gets its end of stream
+    await asyncio.wait_for(consumer, 5)
+    return service, accepted, updates
+
+
+def benchmark_service_close(n_trades=2_000):
+    print(f"=== TradeService closed while a source is still feeding ===")
+    trades = generate_trades(n_trades, symbols=["AAPL", "MSFT"], trades_per_minute=20)
+    t1 = time.perf_counter()
+    service, accepted, updates = asyncio.run(_close_while_feeding(trades))
+    assert 0 < len(accepted) < n_trades
+    assert service.n_trades == len(accepted), (service.n_trades, len(accepted))
+    print(f"closed after {len(accepted)} of {n_trades} trades in {time.perf_counter() - t1:.3f}s, every accepted trade "
+          f"ingested, {len(updates)} updates, later puts rejected")
+
+
+if __name__ == "__main__":
+    benchmark_vwap_window_size()
+    benchmark_rolling_statistics()
+    benchmark_batch_vs_stream()
+    benchmark_many_symbols()
+    benchmark_vwap_history()
+    benchmark_snapshot_restore()
+    benchmark_trade_store()
+    benchmark_service_latency()
+    benchmark_service_close()
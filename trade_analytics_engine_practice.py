@@ -1,19 +1,45 @@
+import asyncio
+import bisect
 import datetime
 import csv
 import collections
+import json
+import math
+import os
+import numpy as np
 import pandas as pd
 
-_datetime_format = "%Y-%m-%dT%H:%M:%SZ"
+import binary_ticks
+import timestamps
 
 class CircularWindow:
+    __slots__ = ("elems", "tail", "cums")
+
     def __init__(self, capacity):
-        self.elems = [None for _ in range(capacity)]
+        # one extra slot keeps the running totals from just before the oldest element
+        self.elems = [None for _ in range(capacity + 1)]
         self.tail = len(self.elems) - 1
+        # running totals of every _sums field up to and including each slot,
+        # so the sums over any window are the difference of two slots
+        self.cums = [self._sums(None) for _ in range(capacity + 1)]
+
+    @staticmethod
+    def _sums(elem):
+        # p*q, q, element count
+        if elem is None:
+            return 0.0, 0.0, 0
+        return elem[1] * elem[2], elem[2], 1
 
     def append(self, elem):
+        prev_tail = self.tail
         self.tail = (self.tail + 1) % len(self.elems)
         cur_elem = self.elems[self.tail]
         self.elems[self.tail] = elem
+        self.cums[self.tail] = tuple(c + v for c, v in zip(self.cums[prev_tail], self._sums(elem)))
+        if self.tail == 0 and any(self.cums[1]):
+            # rebase once per lap so the totals stay window sized and window differences keep their precision
+            base = self.cums[1]
+            self.cums = [tuple(c - b for c, b in zip(cums, base)) for cums in self.cums]
         return cur_elem
 
     def _get_tail_i(self, delta=0):
@@ -32,175 +58,1051 @@ class CircularWindow:
         i = self._get_tail_i(delta=delta)
         cur_elem = self.elems[i]
         self.elems[i] = elem
+
+        diffs = [v - cur_v for v, cur_v in zip(self._sums(elem), self._sums(cur_elem))]
+        for d in range(delta, 1):
+            j = self._get_tail_i(delta=d)
+            self.cums[j] = tuple(c + diff for c, diff in zip(self.cums[j], diffs))
         return cur_elem
 
+    def get_sums(self, window_size_minutes, tail_delta):
+        end = self.cums[self._get_tail_i(delta=tail_delta)]
+        start = self.cums[self._get_tail_i(delta=tail_delta - window_size_minutes)]
+        return tuple(e - s for e, s in zip(end, start))
+
     def get_vwap(self, vwap_window_size_minutes, tail_delta):
-        vwap_elems = self.get_as_list(l=vwap_window_size_minutes, tail_delta=tail_delta)
-        vwap_elems = [e for e in vwap_elems if e is not None]
-        if vwap_elems:
-            vwap = sum([e[1] * e[2] for e in vwap_elems]) / sum([e[2] for e in vwap_elems])
-        else:
-            vwap = None
-        return vwap
+        pq, q, n = self.get_sums(vwap_window_size_minutes, tail_delta)[:3]
+        if n == 0:
+            return None
+        return pq / q
+
+
+async def tail_csv(file_name, follow=True, poll_interval_seconds=0.5):
+    # yields csv rows as dicts while the file grows, a trailing line without a newline is held back until complete,
+    # with follow=False it stops at the end of the file
+    with open(file_name, 'r', newline='') as csvfile:
+        fieldnames = None
+        pending = ""
+        while True:
+            line = csvfile.readline()
+            if not line.endswith("\n"):
+                pending += line
+                if not follow:
+                    if pending and fieldnames:
+                        yield dict(zip(fieldnames, next(csv.reader([pending]))))
+                    return
+                await asyncio.sleep(poll_interval_seconds)
+                continue
+            line, pending = pending + line, ""
+            values = next(csv.reader([line]))
+            if fieldnames is None:
+                fieldnames = values
+            elif values:
+                yield dict(zip(fieldnames, values))
+
+
+class MinuteHistory:
+    # one value (or row of width values) per epoch minute for a contiguous run of minutes, NaN for no value,
+    # keeps at most retention_minutes of them, slot = minute % capacity and capacity doubles up to retention_minutes
+    __slots__ = ("retention_minutes", "values", "first_minute", "last_minute")
+
+    def __init__(self, retention_minutes, width=None, initial_capacity=16):
+        self.retention_minutes = retention_minutes
+        self.values = self._empty(min(initial_capacity, retention_minutes), width)
+        self.first_minute = self.last_minute = None
+
+    @staticmethod
+    def _empty(capacity, width):
+        return np.full((capacity,) if width is None else (capacity, width), np.nan)
+
+    def _grow(self, n_minutes):
+        capacity = len(self.values)
+        new_capacity = min(max(n_minutes, 2 * capacity), self.retention_minutes)
+        values = self._empty(new_capacity, None if self.values.ndim == 1 else self.values.shape[1])
+        minutes = np.arange(self.first_minute, self.last_minute + 1)
+        values[minutes % new_capacity] = self.values[minutes % capacity]
+        self.values = values
+
+    def set(self, minute, value):
+        if self.first_minute is None:
+            self.first_minute = self.last_minute = minute
+        elif minute == self.last_minute + 1:
+            n_minutes = minute - self.first_minute + 1
+            if n_minutes > len(self.values) and len(self.values) < self.retention_minutes:
+                self._grow(n_minutes)
+            self.last_minute = minute
+            self.first_minute = max(self.first_minute, minute - len(self.values) + 1)
+        elif minute <= self.last_minute - self.retention_minutes:
+            # older than the retention
+            return
+        elif not self.first_minute <= minute <= self.last_minute:
+            self._extend(minute)
+        self.values[minute % len(self.values)] = value
+
+    def _extend(self, minute):
+        # minutes between the current range and minute start out as NaN
+        first_minute, last_minute = min(self.first_minute, minute), max(self.last_minute, minute)
+        first_minute = max(first_minute, last_minute - self.retention_minutes + 1)
+        if last_minute - first_minute + 1 > len(self.values):
+            self._grow(last_minute - first_minute + 1)
+        capacity = len(self.values)
+        first_minute = max(first_minute, last_minute - capacity + 1)
+        new_minutes = [m for m in range(first_minute, last_minute + 1) if not self.first_minute <= m <= self.last_minute]
+        self.values[np.array(new_minutes, dtype=np.int64) % capacity] = np.nan
+        self.first_minute, self.last_minute = first_minute, last_minute
+
+    def get(self, minute):
+        if self.first_minute is None or not self.first_minute <= minute <= self.last_minute:
+            return None
+        return self.values[minute % len(self.values)]
+
+    def get_range(self, first_minute, last_minute):
+        # (minutes, values) for the retained minutes in [first_minute, last_minute]
+        if self.first_minute is None:
+            return np.zeros(0, dtype=np.int64), self.values[:0]
+        minutes = np.arange(max(first_minute, self.first_minute), min(last_minute, self.last_minute) + 1)
+        return minutes, self.values[minutes % len(self.values)]
+
+    def restore(self, first_minute, values, capacity):
+        # values of consecutive minutes from first_minute, into a ring as large as the one they were taken from
+        self.values = self._empty(capacity, None if self.values.ndim == 1 else self.values.shape[1])
+        self.first_minute = self.last_minute = None
+        if len(values):
+            self.first_minute, self.last_minute = first_minute, first_minute + len(values) - 1
+            self.values[np.arange(self.first_minute, self.last_minute + 1) % capacity] = values
+
+
+# TradeStore columns, seq is the arrival order across every symbol
+_trade_columns = {"timestamp": np.int64, "side": np.int8, "price": np.float64, "quantity": np.float64, "seq": np.int64}
+
+# epoch seconds, binary_ticks.side_codes code (0 unknown), price, quantity
+TradeColumns = collections.namedtuple("TradeColumns", ["timestamp", "side", "price", "quantity"])
+
+
+def _merge_rows(columns, n, block, capacity):
+    # the first n rows of columns with the time-sorted block rows, which arrived after all of them, merged
+    # in by timestamp into new arrays of capacity rows
+    k = len(block["timestamp"])
+    positions = np.searchsorted(columns["timestamp"][:n], block["timestamp"], side="right") + np.arange(k)
+    kept = np.ones(n + k, dtype=bool)
+    kept[positions] = False
+    merged = {}
+    for name, column in columns.items():
+        values = merged[name] = np.empty(capacity, column.dtype)
+        values[positions] = block[name]
+        values[:n + k][kept] = column[:n]
+    return merged
+
+
+# a partition's late buffer is merged into its columns once it holds more than this, or 1/64 of the partition
+_min_late_merge_rows = 1024
+
+
+class _TradePartition:
+    # one symbol's trades, the first n rows of every column are used, in timestamp order (ties in arrival order).
+    # a trade older than the newest one waits in late, a small side buffer in the same order as python lists,
+    # until that outgrows the partition's share and is merged into new arrays
+    __slots__ = ("n", "columns", "late")
+
+    def __init__(self, capacity):
+        self.n = 0
+        self.columns = {name: np.empty(capacity, dtype) for name, dtype in _trade_columns.items()}
+        self.late = {name: [] for name in _trade_columns}
+
+    def reserve(self, n):
+        capacity = len(self.columns["seq"])
+        if self.n + n > capacity:
+            capacity = max(self.n + n, 2 * capacity)
+            for name, column in self.columns.items():
+                grown = np.empty(capacity, column.dtype)
+                grown[:self.n] = column[:self.n]
+                self.columns[name] = grown
+
+    def compact(self):
+        self.merge_late()
+        self.columns = {name: column[:self.n].copy() for name, column in self.columns.items()}
+
+    def add_late(self, t, side, p, q, seq):
+        late = self.late
+        i = bisect.bisect_right(late["timestamp"], t)
+        for name, value in (("timestamp", t), ("side", side), ("price", p), ("quantity", q), ("seq", seq)):
+            late[name].insert(i, value)
+        if len(late["seq"]) > max(_min_late_merge_rows, self.n >> 6):
+            self.merge_late()
+
+    def merge_late(self):
+        if self.late["seq"]:
+            late = {name: np.array(values, _trade_columns[name]) for name, values in self.late.items()}
+            self.late = {name: [] for name in _trade_columns}
+            self.merge(late)
+
+    def merge(self, block):
+        # into new arrays, so views handed out before keep their rows
+        n = self.n + len(block["timestamp"])
+        self.columns = _merge_rows(self.columns, self.n, block, max(n, len(self.columns["seq"])))
+        self.n = n
+
+
+class TradeStore:
+    # append-only raw trades, columnar per symbol and kept in time order, so a time range is two binary searches
+    # and comes back as views, late trades wait in a small sorted side buffer per symbol that scan merges in,
+    # 33 bytes per trade plus at most as much again of growth headroom until compact()
+    def __init__(self, initial_capacity=16):
+        self.initial_capacity = initial_capacity
+        self.symbol_ids = {}
+        self.symbols = []
+        self.partitions = []
+        self.n_trades = 0
+
+    def __len__(self):
+        return self.n_trades
+
+    def symbol_id(self, s):
+        i = self.symbol_ids.get(s)
+        if i is None:
+            i = self.symbol_ids[s] = len(self.symbols)
+            self.symbols.append(s)
+            self.partitions.append(_TradePartition(self.initial_capacity))
+        return i
+
+    def append(self, t, s, side, p, q):
+        # t a datetime, timestamp string or epoch seconds, side "BUY", "SELL" or its code
+        if type(side) == str:
+            side = binary_ticks.side_codes.get(side, 0)
+        t, p, q = _epoch_seconds(t), float(p), float(q)
+        self.append_by_id(t, self.symbol_id(s), side, p, q)
+
+    def append_by_id(self, t, symbol_id, side, p, q):
+        # t epoch seconds, symbol_id from symbol_id()
+        partition = self.partitions[symbol_id]
+        i = partition.n
+        if i and t < partition.columns["timestamp"][i - 1]:
+            partition.add_late(t, side, p, q, self.n_trades)
+            self.n_trades += 1
+            return
+        partition.reserve(1)
+        columns = partition.columns
+        columns["timestamp"][i] = t
+        columns["side"][i] = side
+        columns["price"][i] = p
+        columns["quantity"][i] = q
+        columns["seq"][i] = self.n_trades
+        partition.n += 1
+        self.n_trades += 1
+
+    def extend(self, t, symbol_ids, sides, p, q):
+        # numpy columns of a batch in arrival order, one block copy per symbol in it
+        n = len(t)
+        seqs = np.arange(self.n_trades, self.n_trades + n)
+        order = np.argsort(symbol_ids, kind="stable")
+        ids, starts = np.unique(symbol_ids[order], return_index=True)
+        ends = np.append(starts[1:], n)
+        for i, start, end in zip(ids.tolist(), starts.tolist(), ends.tolist()):
+            rows = order[start:end]
+            partition = self.partitions[i]
+            block_t = t[rows]
+            if partition.n and block_t[0] < partition.columns["timestamp"][partition.n - 1] or \
+                    np.any(block_t[1:] < block_t[:-1]):
+                # out of order, merged in time order once the late buffer is, since it arrived before the block
+                rows = rows[np.argsort(block_t, kind="stable")]
+                partition.merge_late()
+                partition.merge({"timestamp": t[rows], "side": sides[rows], "price": p[rows],
+                                 "quantity": q[rows], "seq": seqs[rows]})
+                continue
+            partition.reserve(len(rows))
+            columns = partition.columns
+            for name, values in (("timestamp", block_t), ("side", sides[rows]), ("price", p[rows]),
+                                 ("quantity", q[rows]), ("seq", seqs[rows])):
+                columns[name][partition.n:partition.n + len(rows)] = values
+            partition.n += len(rows)
+        self.n_trades += n
+
+    def compact(self):
+        # drops the growth headroom, e.g. once a bulk load is done
+        for partition in self.partitions:
+            partition.compact()
+
+    def load_csv(self, file_name, chunk_size=1_000_000):
+        # malformed rows are dropped like in binary_ticks.convert_csv, returns (n_rows, n_dropped)
+        n_rows = n_dropped = 0
+        for df in pd.read_csv(file_name, dtype={"timestamp": str, "symbol": str, "side": str},
+                              usecols=lambda name: name in binary_ticks.csv_columns, index_col=False,
+                              keep_default_na=False, chunksize=chunk_size):
+            t, valid = timestamps.parse_epoch_seconds_array(df["timestamp"].to_numpy())
+            p = pd.to_numeric(df["price"], errors="coerce").to_numpy(dtype=np.float64)
+            q = pd.to_numeric(df["quantity"], errors="coerce").to_numpy(dtype=np.float64)
+            valid &= np.isfinite(p) & np.isfinite(q)
+            codes, symbols = pd.factorize(df["symbol"].to_numpy()[valid])
+            symbol_ids = np.array([self.symbol_id(s) for s in symbols], dtype=np.int32)
+            sides = np.zeros(int(valid.sum()), dtype=np.int8)
+            if "side" in df:
+                sides = df["side"][valid].map(binary_ticks.side_codes).fillna(0).to_numpy(dtype=np.int8)
+            self.extend(t[valid], symbol_ids[codes] if len(codes) else codes, sides, p[valid], q[valid])
+            n_rows += len(codes)
+            n_dropped += len(df) - len(codes)
+        self.compact()
+        return n_rows, n_dropped
+
+    def load_tick_file(self, file_name):
+        # binary trade file written by binary_ticks.convert_csv
+        tick_file = binary_ticks.TickFile(file_name)
+        symbol_ids = np.array([self.symbol_id(s) for s in tick_file.symbols], dtype=np.int32)
+        for batch in tick_file.iter_batches(1 << 20):
+            self.extend(batch["timestamp"], symbol_ids[batch["symbol_id"]], batch["side"],
+                        batch["price"], batch["quantity"])
+        self.compact()
+        return len(tick_file)
+
+    def scan(self, s, t0=None, t1=None):
+        # s's trades with t0 <= timestamp <= t1 in time order, as views that later appends do not change,
+        # or as copies when late trades not merged yet fall in the range
+        i = self.symbol_ids.get(s)
+        if i is None:
+            return TradeColumns(*(np.empty(0, _trade_columns[name]) for name in TradeColumns._fields))
+        partition = self.partitions[i]
+        t0 = None if t0 is None else _epoch_seconds(t0)
+        t1 = None if t1 is None else _epoch_seconds(t1)
+        seconds = partition.columns["timestamp"][:partition.n]
+        start = 0 if t0 is None else int(np.searchsorted(seconds, t0, side="left"))
+        end = partition.n if t1 is None else int(np.searchsorted(seconds, t1, side="right"))
+        columns = {name: partition.columns[name][start:end] for name in TradeColumns._fields}
+
+        late_seconds = partition.late["timestamp"]
+        late_start = 0 if t0 is None else bisect.bisect_left(late_seconds, t0)
+        late_end = len(late_seconds) if t1 is None else bisect.bisect_right(late_seconds, t1)
+        if late_start < late_end:
+            late = {name: np.array(partition.late[name][late_start:late_end], _trade_columns[name])
+                    for name in TradeColumns._fields}
+            columns = _merge_rows(columns, end - start, late, end - start + late_end - late_start)
+        return TradeColumns(**columns)
+
+    def volume(self, s, t0=None, t1=None, side=None):
+        # summed quantity, of one side ("BUY", "SELL" or its code) if given
+        trades = self.scan(s, t0, t1)
+        if side is None:
+            return float(trades.quantity.sum())
+        if type(side) == str:
+            side = binary_ticks.side_codes[side]
+        return float(trades.quantity[trades.side == side].sum())
+
+    def iter_batches(self, batch_size=65536):
+        # (symbol ids, TradeColumns) per batch_size trades in arrival order, copies, 12 bytes a trade for the lookup
+        for partition in self.partitions:
+            partition.merge_late()
+        partition_ids = np.empty(self.n_trades, dtype=np.int32)
+        rows = np.empty(self.n_trades, dtype=np.int64)
+        for i, partition in enumerate(self.partitions):
+            seqs = partition.columns["seq"][:partition.n]
+            partition_ids[seqs] = i
+            rows[seqs] = np.arange(partition.n)
+
+        for start in range(0, self.n_trades, batch_size):
+            ids, batch_rows = partition_ids[start:start + batch_size], rows[start:start + batch_size]
+            order = np.argsort(ids, kind="stable")
+            unique_ids, starts = np.unique(ids[order], return_index=True)
+            ends = np.append(starts[1:], len(ids))
+            batch = TradeColumns(*(np.empty(len(ids), _trade_columns[name]) for name in TradeColumns._fields))
+            for i, first, last in zip(unique_ids.tolist(), starts.tolist(), ends.tolist()):
+                positions = order[first:last]
+                columns = self.partitions[i].columns
+                for name, values in zip(TradeColumns._fields, batch):
+                    values[positions] = columns[name][batch_rows[positions]]
+            yield ids, batch
+
+
+class FinalizedVwapStream:
+    # async iterator of (symbol, minute, vwap) as Engine finalizes them
+    def __init__(self, engine):
+        self._engine = engine
+        self._queue = asyncio.Queue()
+        engine.subscribe(self._on_finalized)
+
+    def _on_finalized(self, symbol, t, vwap):
+        self._queue.put_nowait((symbol, t, vwap))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+    def close(self):
+        self._engine.unsubscribe(self._on_finalized)
+
+
+_min_minute, _max_minute = np.iinfo(np.int64).min // 120, np.iinfo(np.int64).max // 120
+
+
+def _epoch_seconds(t):
+    # datetime, timestamp string or epoch seconds
+    if type(t) == str:
+        return timestamps.parse_epoch_seconds(t)
+    return timestamps.to_epoch_seconds(t)
+
+
+def _epoch_minute(t):
+    return _epoch_seconds(t) // 60
+
+
+# bumped whenever the arrays or metadata Engine.snapshot writes change
+_snapshot_version = 2
+_no_minute = np.iinfo(np.int64).min
+
+
+def _int_fields(rows, width):
+    # fields that are python ints in every row, so restore can give them back as ints
+    return [all(type(row[k]) is int for row in rows) for k in range(width)]
 
 
 def _parse_tpq(t, p, q):
     if type(t) == str:
-        t = datetime.datetime.strptime(t, _datetime_format)
+        t = timestamps.parse_datetime(t)
     if type(p) == str:
         p = float(p)
     if type(q) == str:
         q = float(q)
     return t, p, q
 
+class _SymbolState:
+    # everything Engine keeps per symbol, one object per interned symbol id
+    __slots__ = ("symbol", "total_quantity", "n_trades", "cirular_window", "history", "watermark",
+                 "window", "pq_sum", "q_sum", "last_price")
+
+    def __init__(self, symbol, cirular_window, history):
+        self.symbol = symbol
+        # avg trade size
+        self.total_quantity = 0.0
+        self.n_trades = 0
+        # vwap
+        self.cirular_window = cirular_window
+        self.history = history
+        # last epoch minute whose vwap is final, None before the first trade
+        self.watermark = None
+        # deque based vwap, see Engine.ingest, only created when that path is used
+        self.window = None
+        self.pq_sum = 0.0
+        self.q_sum = 0.0
+        # realized volatility, see RollingEngine
+        self.last_price = None
+
+
 class Engine:
-    def __init__(self, vwap_window_size_minutes=5, grace_period_minutes=3):
+    # trades at or behind their symbol's watermark are dropped into late_trades, the newest
+    # max_late_trades of them are kept there until drain_late_trades()
+    def __init__(self, vwap_window_size_minutes=5, grace_period_minutes=3, retention_minutes=24 * 60,
+                 max_late_trades=100_000):
         self.vwap_window_size_minutes = vwap_window_size_minutes
         self.grace_period_minutes = grace_period_minutes
         self.circular_window_size_minutes = self.vwap_window_size_minutes + self.grace_period_minutes
+        # minutes of vwap history kept per symbol, late trades still need the last grace_period_minutes
+        # and finalizing reads the minute grace_period_minutes behind the newest one
+        if retention_minutes <= grace_period_minutes:
+            raise ValueError(f"{retention_minutes=} must be more than {grace_period_minutes=}")
+        self.retention_minutes = retention_minutes
+        self.max_late_trades = max_late_trades
+        self.subscribers = []
         self._reset()
 
+    def _config(self):
+        # constructor arguments, for restore
+        return {"vwap_window_size_minutes": self.vwap_window_size_minutes,
+                "grace_period_minutes": self.grace_period_minutes,
+                "retention_minutes": self.retention_minutes, "max_late_trades": self.max_late_trades}
+
     def _reset(self):
+        # symbol -> dense integer id, the index into self.states
+        self.symbol_ids = {}
+        self.states = []
+        # dropped late trades as (t, s, p, q), n_late_dropped counts the ones that fell off too
+        self.late_trades = collections.deque(maxlen=self.max_late_trades)
+        self.n_late_dropped = 0
+        # trades with a NaN or infinite price or quantity, they would stay in a window's running sums for good
+        self.n_invalid_dropped = 0
+
+    def symbol_id(self, s):
+        i = self.symbol_ids.get(s)
+        if i is None:
+            i = self.symbol_ids[s] = len(self.states)
+            self.states.append(_SymbolState(s, self._new_window(), self._new_history()))
+        return i
+
+    @property
+    def average_trade_size(self):
+        return {state.symbol: state.total_quantity / state.n_trades for state in self.states if state.n_trades}
+
+    def _ingest_for_trade_size_stat(self, state, q):
         # avg trade size
-        self.total_quantities = collections.defaultdict(float)
-        self.n_trades = collections.defaultdict(int)
-        self.average_trade_size = {}
-
-        # 5min vwap
-        self.vwaps = collections.defaultdict(lambda: [None for _ in range(self.grace_period_minutes)])
-        self.windows = collections.defaultdict(collections.deque)
-        self.cirular_windows = collections.defaultdict(lambda: CircularWindow(self.circular_window_size_minutes))
-        self.pq_sums = collections.defaultdict(float)
-        self.q_sums = collections.defaultdict(float)
-        self.recent_minutes = {}
-
-    def _ingest_for_trade_size_stat(self, s, q):
-        # avg trade size
-        self.total_quantities[s] += q
-        self.n_trades[s] += 1
-        self.average_trade_size[s] = self.total_quantities[s] / self.n_trades[s]
+        state.total_quantity += q
+        state.n_trades += 1
+
+    def _new_window(self):
+        return CircularWindow(self.circular_window_size_minutes)
+
+    def _new_history(self):
+        return MinuteHistory(self.retention_minutes)
+
+    @staticmethod
+    def _decode(value):
+        # a python float from the history, NaN marks no trades
+        return None if value != value else value
+
+    def vwap_at(self, s, t):
+        # vwap of the window ending at minute t, None if s had no trades in it or t is outside the retention
+        i = self.symbol_ids.get(s)
+        if i is None:
+            return None
+        value = self.states[i].history.get(_epoch_minute(t))
+        return None if value is None else self._decode(value.tolist())
+
+    def vwap_range(self, s, t0, t1):
+        # [(minute, vwap)] for every retained minute in [t0, t1]
+        i = self.symbol_ids.get(s)
+        if i is None:
+            return []
+        minutes, values = self.states[i].history.get_range(_epoch_minute(t0), _epoch_minute(t1))
+        return [(timestamps.from_epoch_seconds(minute * 60), self._decode(value))
+                for minute, value in zip(minutes.tolist(), values.tolist())]
+
+    def watermark(self, s):
+        # minute up to which s's vwaps are final
+        i = self.symbol_ids.get(s)
+        if i is None or self.states[i].watermark is None:
+            return None
+        return timestamps.from_epoch_seconds(self.states[i].watermark * 60)
+
+    # callback(symbol, minute, vwap) is called once per minute, when the symbol's watermark passes it,
+    # later trades can no longer change that vwap
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def stream_finalized_vwaps(self):
+        return FinalizedVwapStream(self)
+
+    def _finalize(self, state, watermark):
+        # publish every minute in (state.watermark, watermark]
+        if state.watermark is not None and watermark <= state.watermark:
+            return
+        first_minute = watermark if state.watermark is None else state.watermark + 1
+        state.watermark = watermark
+        if not self.subscribers:
+            return
+        for minute in range(first_minute, watermark + 1):
+            value = state.history.get(minute)
+            if value is None:
+                continue
+            t, value = timestamps.from_epoch_seconds(minute * 60), self._decode(value.tolist())
+            for callback in self.subscribers:
+                callback(state.symbol, t, value)
+
+    def flush(self):
+        # end of stream: every vwap so far becomes final, trades for those minutes are dropped from now on
+        for state in self.states:
+            if state.history.last_minute is not None:
+                self._finalize(state, state.history.last_minute)
+
+    def drain_late_trades(self):
+        late_trades = list(self.late_trades)
+        self.late_trades.clear()
+        return late_trades
+
+    def latest_vwap(self, s):
+        # (minute, vwap) for the symbol's newest minute, None before its first trade
+        i = self.symbol_ids.get(s)
+        if i is None or self.states[i].history.last_minute is None:
+            return None
+        history = self.states[i].history
+        return (timestamps.from_epoch_seconds(history.last_minute * 60),
+                self._decode(history.get(history.last_minute).tolist()))
+
+    @property
+    def vwaps(self):
+        # symbol -> [(minute, vwap)] over the whole retained history
+        return {state.symbol: self.vwap_range(state.symbol, _min_minute, _max_minute) for state in self.states}
+
+    def _new_elem(self, state, t_minutely, p, q):
+        return (t_minutely, p, q,)
+
+    @staticmethod
+    def _merge_elems(cur_elem, elem):
+        # t, p, q
+        t, p, q = elem
+        _, cp, cq = cur_elem
+        return (t, (p*q + cp*cq) / (q+cq), q+cq)
+
+    def _window_value(self, state, tail_delta):
+        return state.cirular_window.get_vwap(self.vwap_window_size_minutes, tail_delta=tail_delta)
 
     def ingest_as_stream(self, t, s, p, q):
+        # parse and check before interning so a malformed trade does not register its symbol
         t, p, q = _parse_tpq(t, p, q)
+        if not (math.isfinite(p) and math.isfinite(q)):
+            self.n_invalid_dropped += 1
+            return
+        symbol_id = self.symbol_ids.get(s)
+        if symbol_id is None:
+            symbol_id = self.symbol_id(s)
+        self.ingest_as_stream_by_id(t, symbol_id, p, q)
+
+    def ingest_as_stream_by_id(self, t, symbol_id, p, q):
+        # t a datetime, p and q floats, symbol_id from symbol_id()
+        if not (math.isfinite(p) and math.isfinite(q)):
+            self.n_invalid_dropped += 1
+            return
         t_minutely = t.replace(second=0)
+        minute = timestamps.to_epoch_seconds(t_minutely) // 60
+        state = self.states[symbol_id]
+        cirular_window = state.cirular_window
+        history = state.history
 
         # avg trade size
-        self._ingest_for_trade_size_stat(s, q)
+        self._ingest_for_trade_size_stat(state, q)
 
         # vwap
-        elem = (t_minutely, p, q,)
-        if s not in self.cirular_windows:
-            t_vwap = t_minutely
+        tail = cirular_window.get_tail()
+        if tail is None:
             t_delta_minutes = 1
         else:
             # from the most recent value
-            tail_t = self.cirular_windows[s].get_tail()[0]
-            t_vwap = tail_t + datetime.timedelta(minutes=1)
-            t_delta = t_minutely - tail_t
+            t_delta = t_minutely - tail[0]
             t_delta_minutes = int(t_delta.total_seconds() // 60)
+        vwap_minute = minute - t_delta_minutes + 1
 
         if t_delta_minutes > 0:
+            elem = self._new_elem(state, t_minutely, p, q)
             while t_delta_minutes > 0:
                 if t_delta_minutes > 1:
-                    self.cirular_windows[s].append(None)
+                    cirular_window.append(None)
                 else:
-                    self.cirular_windows[s].append(elem)
-
-                vwap = self.cirular_windows[s].get_vwap(self.vwap_window_size_minutes, tail_delta=0)
-                self.vwaps[s].append((t_vwap, vwap,))
+                    cirular_window.append(elem)
 
+                history.set(vwap_minute, self._window_value(state, tail_delta=0))
+                # no accepted trade can reach back grace_period_minutes from the newest minute
+                if self.subscribers:
+                    self._finalize(state, vwap_minute - self.grace_period_minutes)
+                else:
+                    state.watermark = vwap_minute - self.grace_period_minutes
                 t_delta_minutes -= 1
-                t_vwap += datetime.timedelta(minutes=1)
+                vwap_minute += 1
 
-        elif t_delta_minutes <= -self.grace_period_minutes:
+        elif minute <= state.watermark:
             # drop late message
-            print(f"late message dropeed: {t}, {s}, {p}, {q}")
+            self.late_trades.append((t, state.symbol, p, q))
+            self.n_late_dropped += 1
         else:
-            tail = self.cirular_windows[s].get_tail(delta=t_delta_minutes)
+            tail = cirular_window.get_tail(delta=t_delta_minutes)
+            sum_elem = self._new_elem(state, t_minutely, p, q)
             if tail:
-                ct, cp, cq = self.cirular_windows[s].get_tail(delta=t_delta_minutes)
-                assert ct == t_minutely, f"{ct=} not same as {t_minutely=}"
-                # t, p, q
-                sum_elem = (t_minutely, (p*q + cp*cq) / (q+cq), q+cq)
-            else:
-                sum_elem = (t_minutely, p, q)
-            self.cirular_windows[s].update_tail(sum_elem, delta=t_delta_minutes)
+                assert tail[0] == t_minutely, f"{tail[0]=} not same as {t_minutely=}"
+                sum_elem = self._merge_elems(tail, sum_elem)
+            cirular_window.update_tail(sum_elem, delta=t_delta_minutes)
             
-            t_vwap = t_minutely
+            vwap_minute = minute
             while t_delta_minutes <= 0:
-                vwap = self.cirular_windows[s].get_vwap(self.vwap_window_size_minutes, tail_delta=t_delta_minutes)
-                i = len(self.vwaps[s])-1+t_delta_minutes
-                self.vwaps[s][i] = (t_vwap, vwap,)
+                history.set(vwap_minute, self._window_value(state, tail_delta=t_delta_minutes))
                 t_delta_minutes += 1
-                t_vwap += datetime.timedelta(minutes=1)
+                vwap_minute += 1
 
-    def _prune_window(self, s, windows, pq_sums, q_sums):
-        while windows[s]:
-            if windows[s][-1][0] - windows[s][0][0] < datetime.timedelta(minutes=self.vwap_window_size_minutes):
+    def _prune_window(self, state):
+        while state.window:
+            if state.window[-1][0] - state.window[0][0] < datetime.timedelta(minutes=self.vwap_window_size_minutes):
                 break
 
-            _, lp, lq = windows[s].popleft()
-            pq_sums[s] -= lp * lq
-            q_sums[s] -= lq
+            _, lp, lq = state.window.popleft()
+            state.pq_sum -= lp * lq
+            state.q_sum -= lq
 
     def ingest(self, t, s, p, q):
         t, p, q = _parse_tpq(t, p, q)
         t_minutely = t.replace(second=0)
+        state = self.states[self.symbol_id(s)]
 
         # avg trade size
-        self._ingest_for_trade_size_stat(s, q)
+        self._ingest_for_trade_size_stat(state, q)
 
         # vwap
         try:
-            self.windows[s].append((t_minutely, p, q,))
-            self.pq_sums[s] += p * q
-            self.q_sums[s] += q
-            self._prune_window(s, self.windows, self.pq_sums, self.q_sums)
+            if state.window is None:
+                state.window = collections.deque()
+            state.window.append((t_minutely, p, q,))
+            state.pq_sum += p * q
+            state.q_sum += q
+            self._prune_window(state)
             
-            vwap = round(self.pq_sums[s] / self.q_sums[s], 3)
-            if s not in self.recent_minutes or t_minutely > self.recent_minutes[s]:
-                self.vwaps[s].append((t_minutely, vwap,))
-            else:
-                self.vwaps[s][-1] = (t_minutely, vwap,)
-            self.recent_minutes[s] = t_minutely
+            vwap = round(state.pq_sum / state.q_sum, 3)
+            state.history.set(timestamps.to_epoch_seconds(t_minutely) // 60, vwap)
         except Exception as e:
             print(f"exception {e}, for {t}, {s}, {p}, {q}")
 
-    def analyze_file(self, file_name):
+    def _ingest_row(self, row):
+        # csv.DictReader style dict or a (t, s, p, q) tuple
+        try:
+            if isinstance(row, dict):
+                s, (t, p, q) = row['symbol'], _parse_tpq(row['timestamp'], row['price'], row['quantity'])
+            else:
+                t, s, p, q = row
+            self.ingest_as_stream(t, s, p, q)
+        except Exception as e:
+            print(f"[analyze_file] exception {e}, at {row}")
+
+    def ingest_file(self, file_name, offset=0, chunk_size=1 << 20, follow=True):
+        # csv rows from byte offset on, 0 or the header's end for the whole file, a trailing line without
+        # a newline is left for the next call unless follow is False, i.e. the file is complete,
+        # returns the offset to continue from, e.g. for snapshot()
+        with open(file_name, "rb") as f:
+            fieldnames = next(csv.reader([f.readline().decode()]))
+            offset = max(offset, f.tell())
+            f.seek(offset)
+            pending = b""
+            while chunk := f.read(chunk_size):
+                chunk = pending + chunk
+                end = chunk.rfind(b"\n") + 1
+                pending = chunk[end:]
+                self.ingest_rows(csv.DictReader(chunk[:end].decode().splitlines(), fieldnames=fieldnames))
+                offset += end
+            if pending and not follow:
+                self.ingest_rows(csv.DictReader([pending.decode()], fieldnames=fieldnames))
+                offset += len(pending)
+        return offset
+
+    def snapshot(self, file_name, input_offset=0):
+        # the ingest_as_stream state (circular windows, trade size sums, watermarks, retained vwaps and late trades)
+        # as numpy arrays in one npz file, input_offset is where the input picks up again after restore()
+        if any(state.window is not None for state in self.states):
+            raise ValueError("snapshot covers the ingest_as_stream state, not the deque of Engine.ingest")
+        elems = [elem for state in self.states for elem in state.cirular_window.elems]
+        present = [elem[1:] for elem in elems if elem is not None]
+        elem_width = len(present[0]) if present else 0
+        cums = [cums for state in self.states for cums in state.cirular_window.cums]
+        histories = [state.history for state in self.states]
+        history_ranges = [history.get_range(_min_minute, _max_minute) for history in histories]
+        late_trades = list(self.late_trades)
+        meta = {"version": _snapshot_version, "engine": type(self).__name__, "config": self._config(),
+                "symbols": [state.symbol for state in self.states], "input_offset": input_offset,
+                "n_late_dropped": self.n_late_dropped, "n_invalid_dropped": self.n_invalid_dropped,
+                "elem_int_fields": _int_fields(present, elem_width),
+                "cums_int_fields": _int_fields(cums, len(cums[0]) if cums else 0)}
+
+        arrays = {
+            "meta": np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+            "total_quantity": np.array([state.total_quantity for state in self.states], dtype=np.float64),
+            "n_trades": np.array([state.n_trades for state in self.states], dtype=np.int64),
+            "watermark": np.array([_no_minute if state.watermark is None else state.watermark
+                                   for state in self.states], dtype=np.int64),
+            "last_price": np.array([np.nan if state.last_price is None else state.last_price
+                                    for state in self.states], dtype=np.float64),
+            "tail": np.array([state.cirular_window.tail for state in self.states], dtype=np.int64),
+            "elem_minute": np.array([_no_minute if elem is None else timestamps.to_epoch_seconds(elem[0]) // 60
+                                     for elem in elems], dtype=np.int64),
+            "elem_values": np.array([(0.0,) * elem_width if elem is None else elem[1:] for elem in elems],
+                                    dtype=np.float64).reshape(len(elems), elem_width),
+            "cums": np.array(cums, dtype=np.float64),
+            "history_capacity": np.array([len(history.values) for history in histories], dtype=np.int64),
+            "history_first_minute": np.array([minutes[0] if len(minutes) else _no_minute
+                                              for minutes, _ in history_ranges], dtype=np.int64),
+            "history_length": np.array([len(minutes) for minutes, _ in history_ranges], dtype=np.int64),
+            "history_values": np.concatenate([values for _, values in history_ranges])
+            if history_ranges else self._new_history().values[:0],
+            "late_timestamp": np.array([timestamps.to_epoch_seconds(t) for t, _, _, _ in late_trades], dtype=np.int64),
+            "late_symbol_id": np.array([self.symbol_ids[s] for _, s, _, _ in late_trades], dtype=np.int64),
+            "late_price": np.array([p for _, _, p, _ in late_trades], dtype=np.float64),
+            "late_quantity": np.array([q for _, _, _, q in late_trades], dtype=np.float64),
+        }
+        # written aside and renamed, so a crash mid-write leaves the previous snapshot in place
+        with open(file_name + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(file_name + ".tmp", file_name)
+
+    @classmethod
+    def restore(cls, file_name):
+        # (engine, input_offset) from a snapshot() file, subscribers are not part of the snapshot
+        with np.load(file_name, allow_pickle=False) as snapshot:
+            arrays = dict(snapshot)
+        meta = json.loads(arrays["meta"].tobytes())
+        if meta["version"] != _snapshot_version or meta["engine"] != cls.__name__:
+            raise ValueError(f"{file_name} is a version {meta['version']} {meta['engine']} snapshot, "
+                             f"expected version {_snapshot_version} {cls.__name__}")
+        engine = cls(**meta["config"])
+        engine.n_late_dropped = meta["n_late_dropped"]
+        engine.n_invalid_dropped = meta["n_invalid_dropped"]
+
+        n_slots = engine.circular_window_size_minutes + 1
+        elem_minutes = arrays["elem_minute"].tolist()
+        elem_values = arrays["elem_values"].tolist()
+        cums = arrays["cums"].tolist()
+        for fields, int_fields in ((elem_values, meta["elem_int_fields"]), (cums, meta["cums_int_fields"])):
+            int_fields = [k for k, is_int in enumerate(int_fields) if is_int]
+            if int_fields:
+                for row in fields:
+                    for k in int_fields:
+                        row[k] = int(row[k])
+        history_offsets = np.concatenate(([0], np.cumsum(arrays["history_length"])))
+
+        for i, s in enumerate(meta["symbols"]):
+            state = engine.states[engine.symbol_id(s)]
+            state.total_quantity = float(arrays["total_quantity"][i])
+            state.n_trades = int(arrays["n_trades"][i])
+            watermark, last_price = int(arrays["watermark"][i]), float(arrays["last_price"][i])
+            state.watermark = None if watermark == _no_minute else watermark
+            state.last_price = None if last_price != last_price else last_price
+
+            window = state.cirular_window
+            window.tail = int(arrays["tail"][i])
+            slots = range(i * n_slots, (i + 1) * n_slots)
+            window.elems = [None if elem_minutes[j] == _no_minute
+                            else (timestamps.from_epoch_seconds(elem_minutes[j] * 60), *elem_values[j]) for j in slots]
+            window.cums = [tuple(cums[j]) for j in slots]
+
+            state.history.restore(int(arrays["history_first_minute"][i]),
+                                  arrays["history_values"][history_offsets[i]:history_offsets[i + 1]],
+                                  int(arrays["history_capacity"][i]))
+
+        for t, i, p, q in zip(arrays["late_timestamp"].tolist(), arrays["late_symbol_id"].tolist(),
+                              arrays["late_price"].tolist(), arrays["late_quantity"].tolist()):
+            engine.late_trades.append((timestamps.from_epoch_seconds(t), meta["symbols"][i], p, q))
+        return engine, meta["input_offset"]
+
+    def ingest_rows(self, rows, progress=None, progress_every=100_000):
+        # rows are consumed one at a time, so memory does not grow with the source,
+        # progress(n_rows) is called every progress_every rows and once at the end
+        n_rows = 0
+        for row in rows:
+            self._ingest_row(row)
+            n_rows += 1
+            if progress and n_rows % progress_every == 0:
+                progress(n_rows)
+        if progress:
+            progress(n_rows)
+        return n_rows
+
+    async def ingest_rows_async(self, rows, progress=None, progress_every=100_000):
+        # async iterator version of ingest_rows, e.g. over tail_csv of a file that is still being written
+        n_rows = 0
+        async for row in rows:
+            self._ingest_row(row)
+            n_rows += 1
+            if progress and n_rows % progress_every == 0:
+                progress(n_rows)
+        if progress:
+            progress(n_rows)
+        return n_rows
+
+    def analyze_file(self, file_name, progress=None, progress_every=100_000):
         with open(file_name, 'r', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-
-            #rows = sorted([row for row in reader], key=lambda row: row['timestamp'])
-            rows = [row for row in reader]
-            for row in rows: 
-                try:
-                    s, t, p, q = row['symbol'], datetime.datetime.strptime(row['timestamp'], _datetime_format), float(row['price']), float(row['quantity'])
-                    #self.ingest(t, s, p, q)
-                    self.ingest_as_stream(t, s, p, q)                    
-                except Exception as e:
-                    print(f"[analyze_file] exception {e}, at {row}")
+            self.ingest_rows(csv.DictReader(csvfile), progress=progress, progress_every=progress_every)
+
+        return self.average_trade_size, self.vwaps
+
+    def replay(self, file_name):
+        # binary trade file written by binary_ticks.convert_csv, no parsing needed,
+        # file symbol ids are mapped to engine symbol ids once instead of hashing a symbol per trade
+        tick_file = binary_ticks.TickFile(file_name)
+        symbol_ids = [self.symbol_id(s) for s in tick_file.symbols]
+        for batch in tick_file.iter_batches():
+            for t, i, p, q in zip(batch["timestamp"].tolist(), batch["symbol_id"].tolist(),
+                                  batch["price"].tolist(), batch["quantity"].tolist()):
+                self.ingest_as_stream_by_id(timestamps.from_epoch_seconds(t), symbol_ids[i], p, q)
 
         return self.average_trade_size, self.vwaps
     
+    def replay_store(self, store):
+        # a TradeStore, in the order its trades were appended
+        symbol_ids = [self.symbol_id(s) for s in store.symbols]
+        for ids, batch in store.iter_batches():
+            for t, i, p, q in zip(batch.timestamp.tolist(), ids.tolist(), batch.price.tolist(), batch.quantity.tolist()):
+                self.ingest_as_stream_by_id(timestamps.from_epoch_seconds(t), symbol_ids[i], p, q)
+
+        return self.average_trade_size, self.vwaps
+
     def analyze_file_as_dataframe(self, file_name):
-        df = pd.read_csv(file_name)
-        df['quantity'] = df.quantity.astype('float')
-        df_average_trade_size = df.groupby(["symbol"])[["quantity"]].mean()
+        # vectorized equivalent of analyze_file: same late-drop rule and the same time-based window,
+        # returns (average trade size per symbol, window sums and vwap per symbol and minute)
+        # price and quantity only fall back to strings, and the slow to_numeric, when a file has malformed values
+        df = pd.read_csv(file_name, usecols=["timestamp", "symbol", "price", "quantity"], index_col=False,
+                         dtype={"timestamp": str, "symbol": str}, keep_default_na=False)
+        seconds, valid = timestamps.parse_epoch_seconds_array(df.timestamp.to_numpy())
+        p = pd.to_numeric(df.price, errors="coerce").to_numpy(dtype=np.float64)
+        q = pd.to_numeric(df.quantity, errors="coerce").to_numpy(dtype=np.float64)
+        valid &= np.isfinite(p) & np.isfinite(q)
+        codes, symbols = pd.factorize(df.symbol.to_numpy()[valid])
+        minutes, p, q = seconds[valid] // 60, p[valid], q[valid]
+
+        n_symbols = len(symbols)
+
+        # avg trade size, dropped trades count like in ingest_as_stream
+        df_average_trade_size = pd.DataFrame(
+            {"quantity": np.bincount(codes, weights=q, minlength=n_symbols) / np.bincount(codes, minlength=n_symbols)},
+            index=pd.Index(symbols, name="symbol")).sort_index()
+
+        # a trade is dropped once its symbol has already seen a minute grace_period_minutes or more ahead of it,
+        # the running max per symbol is taken in arrival order with an offset per symbol so it never crosses symbols
+        order = np.argsort(codes, kind="stable")
+        accepted = np.ones(len(minutes), dtype=bool)
+        if len(minutes) > 1:
+            sorted_codes, sorted_minutes = codes[order], minutes[order] - minutes.min()
+            span = sorted_minutes.max() + 1
+            latest_minutes = np.maximum.accumulate(sorted_codes * span + sorted_minutes) - sorted_codes * span
+            same_symbol = sorted_codes[1:] == sorted_codes[:-1]
+            accepted[order[1:]] = ~same_symbol | (sorted_minutes[1:] - latest_minutes[:-1] > -self.grace_period_minutes)
+        codes, minutes, p, q = codes[accepted], minutes[accepted], p[accepted], q[accepted]
+
+        # dense minute rows per symbol, from its earliest to its latest accepted minute
+        first_minutes = np.full(n_symbols, np.iinfo(np.int64).max)
+        last_minutes = np.full(n_symbols, np.iinfo(np.int64).min)
+        np.minimum.at(first_minutes, codes, minutes)
+        np.maximum.at(last_minutes, codes, minutes)
+        lengths = last_minutes - first_minutes + 1
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        n_rows = int(lengths.sum())
+        rows = starts[codes] + minutes - first_minutes[codes]
+        row_codes = np.repeat(np.arange(n_symbols), lengths)
+        row_positions = np.arange(n_rows) - starts[row_codes]
+
+        minutely = {"quantity": np.bincount(rows, weights=q, minlength=n_rows),
+                    "pq": np.bincount(rows, weights=p * q, minlength=n_rows),
+                    "n_trades": np.bincount(rows, minlength=n_rows)}
+        window = {}
+        for column, values in minutely.items():
+            # shifted adds stay exact where a cumulative-sum difference would not
+            window[column] = values.copy()
+            for shift in range(1, self.vwap_window_size_minutes):
+                in_symbol = row_positions[shift:] >= shift
+                window[column][shift:] += np.where(in_symbol, values[:-shift], 0)
+
+        df_vwaps = pd.DataFrame(window, index=pd.MultiIndex.from_arrays(
+            [symbols[row_codes], pd.to_datetime((first_minutes[row_codes] + row_positions) * 60, unit="s")],
+            names=["symbol", "t_minutely"]))
+        df_vwaps["vwap"] = (df_vwaps.pq / df_vwaps.quantity).where(df_vwaps.n_trades > 0)
+        return df_average_trade_size, df_vwaps
+
+# per-window sums every rolling statistic is computed from, see MinuteBuckets._sums
+WindowSums = collections.namedtuple("WindowSums", ["pq", "q", "n_minutes", "n_trades", "minute_prices", "squared_returns"])
+
+# name -> function(WindowSums) -> value, new statistics plug in with register_rolling_statistic
+rolling_statistics = {}
+
+
+def register_rolling_statistic(name):
+    def register(func):
+        rolling_statistics[name] = func
+        return func
+    return register
+
+
+@register_rolling_statistic("vwap")
+def _vwap(sums):
+    return sums.pq / sums.q if sums.n_minutes else None
+
+
+@register_rolling_statistic("twap")
+def _twap(sums):
+    # every minute with trades weighs the same, at its mean trade price
+    return sums.minute_prices / sums.n_minutes if sums.n_minutes else None
+
+
+@register_rolling_statistic("volume")
+def _volume(sums):
+    return sums.q
 
-        df['price'] = df.price.astype('float')
-        df['timestamp'] = pd.to_datetime(df.timestamp, format="%Y-%m-%dT%H:%M:%SZ")
-        df['t_minutely'] = df.timestamp.dt.floor('1min')
-        df['pq'] = df.price * df.quantity
 
-        df_minutely = df.groupby(["symbol", "t_minutely"])[["quantity", "pq"]].sum().reset_index().set_index("t_minutely")
-        df_minutely_rolled = df_minutely.groupby(["symbol"]).rolling(5).sum()
-        df_minutely_rolled["vwap"] = df_minutely_rolled.pq / df_minutely_rolled.quantity
+@register_rolling_statistic("trade_count")
+def _trade_count(sums):
+    return sums.n_trades
+
+
+@register_rolling_statistic("realized_volatility")
+def _realized_volatility(sums):
+    # square root of summed squared log returns between consecutive trades
+    return math.sqrt(sums.squared_returns) if sums.n_minutes else None
+
+
+class MinuteBuckets(CircularWindow):
+    # elems are (t, vwap, q, n_trades, sum of prices, sum of squared log returns) per minute
+    __slots__ = ()
+
+    @staticmethod
+    def _sums(elem):
+        if elem is None:
+            return WindowSums(0.0, 0.0, 0, 0, 0.0, 0.0)
+        _, p, q, n, p_sum, r2 = elem
+        return WindowSums(p * q, q, 1, n, p_sum / n, r2)
+
+    def get_sums(self, window_size_minutes, tail_delta):
+        return WindowSums(*super().get_sums(window_size_minutes, tail_delta))
+
+
+class RollingEngine(Engine):
+    # every (statistic, window) pair is served from one MinuteBuckets store per symbol, sized for the longest window,
+    # the history keeps one row of values per minute and values_at / values_range return {(name, window): value}
+    default_statistics = {name: (1, 5, 15, 60) for name in ("vwap", "twap", "volume", "trade_count", "realized_volatility")}
+
+    def __init__(self, statistics=None, grace_period_minutes=3, retention_minutes=24 * 60, max_late_trades=100_000):
+        self.statistics = dict(statistics or self.default_statistics)
+        for name in self.statistics:
+            if name not in rolling_statistics:
+                raise ValueError(f"unknown rolling statistic {name!r}, expected one of {sorted(rolling_statistics)}")
+        self.windows_by_size = collections.defaultdict(list)
+        for name, window_sizes in self.statistics.items():
+            for window_size in window_sizes:
+                self.windows_by_size[window_size].append((name, rolling_statistics[name]))
+        # history column order
+        self.value_keys = [(name, window_size) for window_size, statistics in self.windows_by_size.items()
+                           for name, _ in statistics]
+        super().__init__(vwap_window_size_minutes=max(self.windows_by_size), grace_period_minutes=grace_period_minutes,
+                         retention_minutes=retention_minutes, max_late_trades=max_late_trades)
+
+    def _config(self):
+        return {"statistics": self.statistics, "grace_period_minutes": self.grace_period_minutes,
+                "retention_minutes": self.retention_minutes, "max_late_trades": self.max_late_trades}
+
+    def _new_window(self):
+        return MinuteBuckets(self.circular_window_size_minutes)
+
+    def _new_history(self):
+        return MinuteHistory(self.retention_minutes, width=len(self.value_keys))
+
+    def _decode(self, row):
+        return {key: None if value != value else value for key, value in zip(self.value_keys, row)}
+
+    values_at = Engine.vwap_at
+    values_range = Engine.vwap_range
+
+    @property
+    def rolling_values(self):
+        return self.vwaps
+
+    def _new_elem(self, state, t_minutely, p, q):
+        # returns follow arrival order, so late trades are measured against the trade before them,
+        # a zero or negative price has no log return and leaves the last price alone
+        if p <= 0:
+            return (t_minutely, p, q, 1, p, 0.0)
+        last_p = state.last_price
+        state.last_price = p
+        r2 = math.log(p / last_p) ** 2 if last_p else 0.0
+        return (t_minutely, p, q, 1, p, r2)
+
+    @staticmethod
+    def _merge_elems(cur_elem, elem):
+        t, p, q, n, p_sum, r2 = elem
+        _, cp, cq, cn, cp_sum, cr2 = cur_elem
+        return (t, (p*q + cp*cq) / (q+cq), q+cq, n+cn, p_sum+cp_sum, r2+cr2)
+
+    def _window_value(self, state, tail_delta):
+        # in value_keys order
+        values = []
+        for window_size, statistics in self.windows_by_size.items():
+            sums = state.cirular_window.get_sums(window_size, tail_delta)
+            for _, func in statistics:
+                values.append(func(sums))
+        return values
 
-        return df_average_trade_size, df_minutely_rolled
 
 if __name__ == "__main__":
     e = Engine(grace_period_minutes=6)
     average_trade_size, vwaps = e.analyze_file("bam_quant_dev_mock/trades_aapl.csv")
+    print(f"late trades dropped: {e.n_late_dropped}")
     print("vwaps")
     for symbol, s in average_trade_size.items():
         print(symbol)
@@ -209,11 +1111,7 @@ if __name__ == "__main__":
     print("vwaps")
     for symbol, vs in vwaps.items():
         print(symbol)
-        in_padding = True
         for v in vs:
-            if in_padding and v is None:
-                continue
             print(v)
-            in_padding = False
 
 
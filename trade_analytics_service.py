@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+import trade_analytics_engine_practice
+
+# column order of a trade line on the socket, same as trades.csv
+_socket_fields = ("timestamp", "symbol", "side", "price", "quantity")
+
+# received: time.perf_counter() when the oldest trade behind this update reached the service
+VwapUpdate = collections.namedtuple("VwapUpdate", ["symbol", "minute", "vwap", "received"])
+
+
+class VwapUpdateStream:
+    # bounded, a subscriber that falls behind holds up the batcher and through it the sources
+    def __init__(self, service, maxsize):
+        self._service = service
+        self._queue = asyncio.Queue(maxsize)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        update = await self._queue.get()
+        if update is None:
+            raise StopAsyncIteration
+        return update
+
+    def close(self):
+        self._service.unsubscribe(self)
+        # a batcher blocked on this full queue wakes up, and skips the stream from now on
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+
+class TradeService:
+    # asyncio front-end for an Engine: sources put trades on one bounded queue, a batcher takes whatever
+    # is queued (up to batch_size), groups it by symbol and ingests it on a single engine thread,
+    # then publishes each touched symbol's latest vwap to every subscriber
+    # trades are csv.DictReader style dicts or (t, s, p, q) tuples, as for Engine.ingest_rows
+    def __init__(self, engine=None, batch_size=1024, max_batch_delay_seconds=0.0, max_pending_trades=65536):
+        self.engine = engine if engine is not None else trade_analytics_engine_practice.Engine()
+        self.batch_size = batch_size
+        self.max_batch_delay_seconds = max_batch_delay_seconds
+        self.max_pending_trades = max_pending_trades
+        # the engine is not thread safe, every batch runs on this one thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="trade-engine")
+        self._trades = None
+        self._batcher = None
+        self._closing = False
+        self._subscribers = []
+        self.n_trades = 0
+        self.n_batches = 0
+
+    async def start(self):
+        self._trades = asyncio.Queue(self.max_pending_trades)
+        self._batcher = asyncio.create_task(self._run())
+        return self
+
+    async def close(self):
+        # waits until every queued trade is ingested and published, put() raises from now on,
+        # a put already waiting for room goes ahead of the end marker
+        self._closing = True
+        await self._trades.put(None)
+        await self._batcher
+        for stream in list(self._subscribers):
+            await stream._queue.put(None)
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def subscribe(self, maxsize=1024):
+        stream = VwapUpdateStream(self, maxsize)
+        self._subscribers.append(stream)
+        return stream
+
+    def unsubscribe(self, stream):
+        self._subscribers.remove(stream)
+
+    async def put(self, trade):
+        # waits while max_pending_trades are queued
+        if self._closing:
+            raise RuntimeError("TradeService is closing")
+        await self._trades.put((time.perf_counter(), trade))
+
+    async def feed(self, trades):
+        # an async iterator source, e.g. trade_analytics_engine_practice.tail_csv or a queue reader
+        async for trade in trades:
+            await self.put(trade)
+
+    async def serve_socket(self, host="127.0.0.1", port=0):
+        # one trade per line in trades.csv column order, a header line is skipped
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            async for line in reader:
+                fields = line.decode().strip().split(",")
+                if fields[0] and fields[0] != _socket_fields[0]:
+                    await self.put(dict(zip(_socket_fields, fields)))
+        finally:
+            writer.close()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            batch = [await self._trades.get()]
+            if self.max_batch_delay_seconds and self._trades.qsize() < self.batch_size:
+                await asyncio.sleep(self.max_batch_delay_seconds)
+            # the end marker closes the batch
+            while len(batch) < self.batch_size and batch[-1] is not None and not self._trades.empty():
+                batch.append(self._trades.get_nowait())
+            if batch[-1] is None:
+                closing = True
+                batch.pop()
+            if not batch:
+                continue
+
+            updates = await loop.run_in_executor(self._executor, self._ingest_batch, batch)
+            self.n_trades += len(batch)
+            self.n_batches += 1
+            for update in updates:
+                for stream in list(self._subscribers):
+                    # unless it was closed while an earlier put waited
+                    if stream in self._subscribers:
+                        await stream._queue.put(update)
+
+    def _ingest_batch(self, batch):
+        # on the engine thread, arrival order is kept within each symbol
+        by_symbol = {}
+        for received, trade in batch:
+            try:
+                s = trade["symbol"] if isinstance(trade, dict) else trade[1]
+            except (KeyError, IndexError, TypeError):
+                s = None
+            if s not in by_symbol:
+                by_symbol[s] = (received, [])
+            by_symbol[s][1].append(trade)
+
+        updates = []
+        for s, (received, trades) in by_symbol.items():
+            self.engine.ingest_rows(trades)
+            latest = self.engine.latest_vwap(s)
+            if latest is not None:
+                updates.append(VwapUpdate(s, latest[0], latest[1], received))
+        return updates